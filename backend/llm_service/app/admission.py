@@ -0,0 +1,231 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import HTTPException
+
+# Priority lanes; a lower value is admitted first
+INTERACTIVE = 0
+BATCH = 1
+IMAGE = 2
+
+# Requests that may wait for capacity per provider; beyond that they are rejected
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "256"))
+# Seconds a request may wait in the queue before giving up
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+# Pause after an upstream 429 that did not say how long to wait
+DEFAULT_THROTTLE_SECONDS = 1.0
+# Worker processes serving the app; each gets an equal share of the provider limits
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+
+def provider_limits(name: str) -> Dict[str, float]:
+    """
+    Read `<NAME>_MAX_CONCURRENCY`, `<NAME>_REQUESTS_PER_MINUTE` and
+    `<NAME>_TOKENS_PER_MINUTE`, divided between the worker processes.
+    """
+    prefix = name.upper()
+    return {
+        "max_concurrency": math.ceil(int(os.getenv(f"{prefix}_MAX_CONCURRENCY", "64")) / WORKERS),
+        "requests_per_minute": float(os.getenv(f"{prefix}_REQUESTS_PER_MINUTE", "0")) / WORKERS,
+        "tokens_per_minute": float(os.getenv(f"{prefix}_TOKENS_PER_MINUTE", "0")) / WORKERS,
+    }
+
+
+class TokenBucket:
+    """
+    Holds up to one minute's worth of `per_minute` and refills continuously.
+
+    A rate of 0 means unlimited. The level may go negative when usage turns
+    out higher than estimated; that debt is paid back before the next take.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken, 0 if it can be taken now."""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        # Anything bigger than the bucket only needs a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        if self.rate:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        if self.rate:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class Scheduler:
+    """
+    Admission control for one provider.
+
+    A request is admitted once a concurrency slot is free and both the
+    request and token buckets allow it. Until then it waits in a bounded
+    queue ordered by priority lane, then arrival. When the queue is full a
+    request is rejected straight away with 429 and a Retry-After, and one
+    that waits past its deadline gets 503, so overload sheds the excess
+    instead of slowing every request down.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        queue_size: int = ADMISSION_QUEUE_SIZE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Heap of [priority, seq, tokens, future]; abandoned entries are skipped lazily
+        self._queue = []
+        self._queued = 0
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._paused_until = 0.0
+
+    def _ready_in(self, tokens: float) -> float:
+        return max(
+            self._paused_until - time.monotonic(),
+            self.requests.wait_time(1),
+            self.tokens.wait_time(tokens),
+            0.0,
+        )
+
+    def _admit(self, tokens: float):
+        self.in_flight += 1
+        self.admitted += 1
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._ready_in(1)))
+
+    def _overloaded(self, status_code: int, reason: str) -> HTTPException:
+        return HTTPException(
+            status_code=status_code,
+            detail=f"{self.name} is overloaded: {reason}",
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+    def check(self):
+        """Reject now if a new request could not even be queued."""
+        if self._queued >= self.queue_size:
+            self.rejected += 1
+            raise self._overloaded(429, "too many queued requests")
+
+    async def acquire(self, tokens: float = 0, priority: int = INTERACTIVE, timeout: Optional[float] = None):
+        if not self._queued and self.in_flight < self.max_concurrency and not self._ready_in(tokens):
+            self._admit(tokens)
+            return
+        self.check()
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, [priority, next(self._seq), tokens, future])
+        self._queued += 1
+        self._dispatch()
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(future),
+                self.queue_timeout if timeout is None else timeout
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done():
+                # Admitted just as the wait ended
+                if isinstance(e, asyncio.TimeoutError):
+                    return
+                self.release()
+                raise
+            future.cancel()
+            self._queued -= 1
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.timed_out += 1
+            raise self._overloaded(503, "timed out waiting for capacity")
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue and self.in_flight < self.max_concurrency:
+            _, _, tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+            wait = self._ready_in(tokens)
+            if wait:
+                # Nothing frees up a bucket, so come back once it has refilled
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            self._queued -= 1
+            self._admit(tokens)
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        tokens: float = 0,
+        priority: int = INTERACTIVE,
+        timeout: Optional[float] = None,
+    ) -> AsyncIterator[None]:
+        await self.acquire(tokens, priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def settle(self, estimated: float, actual: Optional[int]):
+        """Correct the token bucket once a call's real usage is known."""
+        if actual is not None:
+            self.tokens.adjust(estimated - actual)
+
+    def throttle(self, seconds: Optional[float] = None):
+        """Stop admitting for a while, e.g. after the upstream said 429."""
+        seconds = DEFAULT_THROTTLE_SECONDS if seconds is None else seconds
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+from typing import Optional
+
+import anyio
+import httpx
+from fastapi import Request
+
+logger = logging.getLogger(__name__)
+
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR") or os.path.join(tempfile.gettempdir(), "llm_service_blobs")
+# Disk budget for stored blobs; the oldest are deleted first once it is exceeded
+BLOB_STORE_MAX_BYTES = int(os.getenv("BLOB_STORE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Base URL clients reach this service on, when it differs from what the
+# request says (e.g. behind a TLS-terminating proxy)
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+
+_BLOB_NAME = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+
+
+class BlobStore:
+    """
+    Content-addressed files on local disk, named `<sha256>.<ext>`.
+
+    Blobs never change once written, so a name doubles as a strong ETag.
+    Once the store grows past `max_bytes`, the least recently written blobs
+    are deleted and their URLs stop resolving.
+    """
+
+    def __init__(self, http: httpx.AsyncClient, directory: str = BLOB_STORE_DIR, max_bytes: int = BLOB_STORE_MAX_BYTES):
+        self.http = http
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = asyncio.Lock()
+        self.size = sum(entry.stat().st_size for entry in self._blobs())
+
+    def _blobs(self):
+        return [entry for entry in os.scandir(self.directory) if _BLOB_NAME.match(entry.name)]
+
+    def _evict(self, keep: str) -> int:
+        entries = sorted(self._blobs(), key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        evicted = 0
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            # The blob just written is about to be handed out
+            if entry.name == keep:
+                continue
+            size = entry.stat().st_size
+            try:
+                os.unlink(entry.path)
+                total -= size
+                evicted += 1
+            except OSError:
+                pass
+        if evicted:
+            logger.info(f"Evicted {evicted} blobs from {self.directory}")
+        return total
+
+    def _store(self, tmp_path: str, name: str) -> int:
+        """Move a finished download into place; return how many bytes the store grew by."""
+        path = os.path.join(self.directory, name)
+        existing = os.path.getsize(path) if os.path.exists(path) else 0
+        # Same bytes always land on the same name, so replacing is harmless
+        # (and refreshes the blob's age)
+        os.replace(tmp_path, path)
+        return os.path.getsize(path) - existing
+
+    def path(self, name: str) -> Optional[str]:
+        if not _BLOB_NAME.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    async def fetch(self, url: str, default_type: str = "image/png") -> str:
+        """Download `url` into the store without buffering it in memory and return its blob name."""
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            async with self.http.stream("GET", url) as response:
+                response.raise_for_status()
+                content_type = response.headers.get("content-type", default_type).split(";")[0]
+                async with await anyio.open_file(tmp_path, "wb") as f:
+                    async for chunk in response.aiter_bytes():
+                        digest.update(chunk)
+                        await f.write(chunk)
+            extension = (mimetypes.guess_extension(content_type) or ".bin").lstrip(".")
+            name = f"{digest.hexdigest()}.{extension}"
+            async with self._lock:
+                self.size += await anyio.to_thread.run_sync(self._store, tmp_path, name)
+                if self.size > self.max_bytes:
+                    self.size = await anyio.to_thread.run_sync(self._evict, name)
+            return name
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+
+def blob_url(request: Request, name: str) -> str:
+    if PUBLIC_BASE_URL:
+        return f"{PUBLIC_BASE_URL}{request.app.url_path_for('get_image', name=name)}"
+    return str(request.url_for("get_image", name=name))
+
+
+def get_blob_store(request: Request) -> BlobStore:
+    return request.app.state.blobs
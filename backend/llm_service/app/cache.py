@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class TieredCache:
+    """
+    JSON values keyed by a hex digest, kept on local disk with an in-memory
+    LRU in front.
+
+    Both tiers are bounded by size: the memory tier by `memory_bytes`, the
+    disk tier by `disk_bytes` (least recently used files go first). With a
+    `ttl`, entries older than that many seconds are treated as missing.
+    """
+
+    def __init__(self, directory: str, memory_bytes: int, disk_bytes: int, ttl: Optional[float] = None):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # key -> (expires_at, size, value)
+        self._memory: "OrderedDict[str, Tuple[Optional[float], int, Any]]" = OrderedDict()
+        self._memory_size = 0
+        self._disk_lock = asyncio.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._disk_size = sum(
+            entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".json")
+        )
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _remember(self, key: str, expires_at: Optional[float], size: int, value: Any):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= old[1]
+        self._memory[key] = (expires_at, size, value)
+        self._memory_size += size
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, (_, evicted_size, _) = self._memory.popitem(last=False)
+            self._memory_size -= evicted_size
+
+    def _forget(self, key: str):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= old[1]
+
+    def _read(self, key: str) -> Optional[Tuple[Optional[float], int, Any]]:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = f.read()
+            entry = json.loads(data)
+            if entry["expires_at"] is not None and entry["expires_at"] < time.time():
+                os.unlink(path)
+                return None
+            # Bump mtime so disk eviction treats it as recently used
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return entry["expires_at"], len(data), entry["value"]
+
+    def _write(self, key: str, data: str) -> int:
+        """Write an entry and return how much the disk tier grew by."""
+        path = self._path(key)
+        try:
+            old_size = os.stat(path).st_size
+        except OSError:
+            old_size = 0
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return len(data) - old_size
+
+    def _evict_disk(self) -> int:
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.disk_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.unlink(entry.path)
+                total -= size
+            except OSError:
+                pass
+        return total
+
+    async def get(self, key: str) -> Any:
+        entry = self._memory.get(key)
+        if entry is not None and entry[0] is not None and entry[0] < time.time():
+            self._forget(key)
+            entry = None
+        if entry is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+        entry = await asyncio.to_thread(self._read, key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.disk_hits += 1
+        self._remember(key, *entry)
+        return entry[2]
+
+    async def put(self, key: str, value: Any):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        data = json.dumps({"expires_at": expires_at, "value": value})
+        self._remember(key, expires_at, len(data), value)
+        try:
+            async with self._disk_lock:
+                self._disk_size += await asyncio.to_thread(self._write, key, data)
+                if self._disk_size > self.disk_bytes:
+                    self._disk_size = await asyncio.to_thread(self._evict_disk)
+        except OSError as e:
+            logger.error(f"Error writing cache entry {key} to {self.directory}: {str(e)}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_bytes": self._disk_size,
+        }
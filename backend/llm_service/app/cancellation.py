@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Awaitable, Optional, TypeVar
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Seconds the caller is still willing to wait for an answer
+TIMEOUT_HEADER = "X-Request-Timeout"
+# Upper bound on what a caller may ask for
+MAX_REQUEST_TIMEOUT = float(os.getenv("MAX_REQUEST_TIMEOUT", "600"))
+
+# Not a real HTTP status: nginx's "client closed request", only ever seen in logs
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ArrivalMiddleware:
+    """Stamps each request with its arrival time, which its deadline counts from."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            # Read back as `request.state.arrived_at`
+            scope.setdefault("state", {})["arrived_at"] = asyncio.get_running_loop().time()
+        await self.app(scope, receive, send)
+
+
+def request_deadline(request: Request) -> Optional[float]:
+    """
+    Event loop time by which the caller wants an answer, from the timeout
+    header. The timeout runs from the request's arrival, so time spent
+    reading uploads and loading history counts against it.
+    """
+    value = request.headers.get(TIMEOUT_HEADER)
+    if value is None:
+        return None
+    try:
+        timeout = float(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {TIMEOUT_HEADER} header: {value}")
+    if timeout <= 0:
+        raise HTTPException(status_code=400, detail=f"{TIMEOUT_HEADER} must be positive")
+    arrived_at = getattr(request.state, "arrived_at", None)
+    if arrived_at is None:
+        arrived_at = asyncio.get_running_loop().time()
+    return arrived_at + min(timeout, MAX_REQUEST_TIMEOUT)
+
+
+def deadline_exceeded() -> HTTPException:
+    return HTTPException(status_code=504, detail="Request deadline exceeded")
+
+
+async def _disconnected(request: Request):
+    # The body has already been read by the time a handler runs, so the next
+    # message is the disconnect
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def until_cancelled(request: Request, awaitable: Awaitable[T]) -> T:
+    """
+    Await `awaitable`, cancelling it if the client disconnects or the
+    request deadline passes first.
+
+    Cancelling releases whatever the call holds (admission slot, upstream
+    connection), and the exception raised here keeps the handler from
+    writing history for a reply nobody will read.
+    """
+    try:
+        deadline = request_deadline(request)
+    except HTTPException:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise
+    call = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_disconnected(request))
+    timeout = None if deadline is None else max(0.0, deadline - asyncio.get_running_loop().time())
+    try:
+        done, _ = await asyncio.wait({call, watcher}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not call.done():
+            call.cancel()
+            await asyncio.gather(call, return_exceptions=True)
+
+    if call in done:
+        return call.result()
+    if watcher in done:
+        logger.info(f"Client disconnected from {request.url.path}, cancelled upstream call")
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+    logger.info(f"Deadline exceeded on {request.url.path}, cancelled upstream call")
+    raise deadline_exceeded()
+
+
+async def with_deadline(items: AsyncIterator[T], deadline: Optional[float]) -> AsyncIterator[T]:
+    """
+    Relay `items` until `deadline` (event loop time), then close them.
+
+    Client disconnects need no handling here: the streaming response stops
+    iterating and the source stream is closed with it.
+    """
+    iterator = items.__aiter__()
+    try:
+        while True:
+            try:
+                if deadline is None:
+                    item = await iterator.__anext__()
+                else:
+                    # Scoped to a single step so the timeout never spans a yield
+                    timeout = max(0.0, deadline - asyncio.get_running_loop().time())
+                    item = await asyncio.wait_for(iterator.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                if deadline is None or asyncio.get_running_loop().time() < deadline:
+                    raise
+                raise deadline_exceeded()
+            yield item
+    finally:
+        await iterator.aclose()
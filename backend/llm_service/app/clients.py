@@ -0,0 +1,86 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+from anthropic import AsyncAnthropic
+from fastapi import HTTPException, Request
+from groq import AsyncGroq
+from openai import AsyncOpenAI
+
+# Connection pool settings shared by every provider client
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "500"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "100"))
+KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "600"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+
+
+def build_http_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+
+@dataclass
+class ProviderClients:
+    openai: Optional[AsyncOpenAI] = None
+    anthropic: Optional[AsyncAnthropic] = None
+    groq: Optional[AsyncGroq] = None
+
+    @classmethod
+    def from_env(cls) -> "ProviderClients":
+        # A client is only created when its key is configured, so the service
+        # still starts (and the other providers keep working) without it
+        clients = cls()
+        if os.getenv("OPENAI_API_KEY"):
+            clients.openai = AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                max_retries=MAX_RETRIES,
+                http_client=build_http_client(),
+            )
+        if os.getenv("ANTHROPIC_API_KEY"):
+            clients.anthropic = AsyncAnthropic(
+                api_key=os.getenv("ANTHROPIC_API_KEY"),
+                max_retries=MAX_RETRIES,
+                http_client=build_http_client(),
+            )
+        if os.getenv("GROQ_API_KEY"):
+            clients.groq = AsyncGroq(
+                api_key=os.getenv("GROQ_API_KEY"),
+                max_retries=MAX_RETRIES,
+                http_client=build_http_client(),
+            )
+        return clients
+
+    async def close(self):
+        for client in (self.openai, self.anthropic, self.groq):
+            if client is not None:
+                await client.close()
+
+
+def _get_client(request: Request, name: str, env_var: str):
+    client = getattr(request.app.state.clients, name)
+    if client is None:
+        raise HTTPException(
+            status_code=500,
+            detail=f"{env_var} not found in environment variables"
+        )
+    return client
+
+
+def get_openai(request: Request) -> AsyncOpenAI:
+    return _get_client(request, "openai", "OPENAI_API_KEY")
+
+
+def get_anthropic(request: Request) -> AsyncAnthropic:
+    return _get_client(request, "anthropic", "ANTHROPIC_API_KEY")
+
+
+def get_groq(request: Request) -> AsyncGroq:
+    return _get_client(request, "groq", "GROQ_API_KEY")
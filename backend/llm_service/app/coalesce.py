@@ -0,0 +1,149 @@
+import asyncio
+import os
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+
+from fastapi import Request
+
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+COALESCED_HEADER = "X-Coalesced"
+
+_DONE = object()
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class _StreamFlight:
+    __slots__ = ("task", "waiters", "items", "changed")
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        # Everything produced so far, so late joiners can replay it
+        self.items: List[Any] = []
+        self.changed = asyncio.Event()
+
+
+class Coalescer:
+    """
+    Single-flight deduplication of identical in-flight upstream calls.
+
+    While a call for a key is running, further calls with the same key wait
+    for it instead of starting their own. A waiter that is cancelled only
+    stops waiting; the shared call is cancelled once nobody is waiting on it.
+    Failures reach every waiter and are not remembered, so the next call
+    after a failure starts fresh.
+    """
+
+    def __init__(self, enabled: bool = COALESCE_ENABLED):
+        self.enabled = enabled
+        self.calls = 0
+        self.coalesced = 0
+        self.failures = 0
+        self._flights: Dict[str, _Flight] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+
+    def _finished(self, key: str, task: asyncio.Task):
+        self._flights.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            self.failures += 1
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return `fn()`'s result, and whether it was shared with an earlier caller."""
+        if not self.enabled:
+            return await fn(), False
+
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finished(key, task))
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        Share one upstream stream between concurrent identical requests.
+
+        Every subscriber receives the full sequence of items, including ones
+        produced before it joined.
+        """
+        if not self.enabled:
+            async for item in factory():
+                yield item
+            return
+
+        flight = self._streams.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            flight = _StreamFlight()
+            self._streams[key] = flight
+            flight.task = asyncio.ensure_future(self._produce(key, flight, factory))
+
+        flight.waiters += 1
+        index = 0
+        try:
+            while True:
+                while index < len(flight.items):
+                    item = flight.items[index]
+                    index += 1
+                    if item is _DONE:
+                        return
+                    if isinstance(item, BaseException):
+                        raise item
+                    yield item
+                flight.changed.clear()
+                await flight.changed.wait()
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    async def _produce(self, key: str, flight: _StreamFlight, factory: Callable[[], AsyncIterator[Any]]):
+        try:
+            async for item in factory():
+                flight.items.append(item)
+                flight.changed.set()
+            flight.items.append(_DONE)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            flight.items.append(e)
+        finally:
+            # New requests from here on start their own stream
+            if self._streams.get(key) is flight:
+                del self._streams[key]
+            flight.changed.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "in_flight": len(self._flights) + len(self._streams),
+        }
+
+
+def get_coalescer(request: Request) -> Coalescer:
+    return request.app.state.coalescer
@@ -0,0 +1,153 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Union
+
+from app.history import StoredMessage, conversations
+from app.tokens import count_message_tokens, count_tokens
+
+# Context window of each model we call, in tokens
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4": 8192,
+    "claude-sonnet-4-20250514": 200000,
+    "llama-3.3-70b-versatile": 128000,
+}
+DEFAULT_CONTEXT_LIMIT = 8192
+
+# Room left in the context window for the reply
+OUTPUT_RESERVE_TOKENS = int(os.getenv("CONTEXT_OUTPUT_RESERVE_TOKENS", "1024"))
+
+# Upper bound on prompt size regardless of model, so cost and latency level off
+MAX_INPUT_TOKENS = int(os.getenv("CONTEXT_MAX_INPUT_TOKENS", "16000"))
+
+SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "1000"))
+
+# How much of each compacted message is carried into the summary
+SUMMARY_LINE_CHARS = 300
+
+# When the window is over budget it is shrunk to this fraction of the budget,
+# so compaction (and the summary it produces) happens every few turns rather
+# than on every turn
+COMPACT_TARGET = 0.75
+
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+
+# A system prompt is plain text, or sections ordered from most to least
+# stable; providers that cache prompt prefixes mark the section boundaries
+SystemPrompt = Union[str, Sequence[str]]
+
+
+@dataclass
+class Context:
+    summary: str
+    messages: List[Dict[str, str]]
+    # Prompt size (system prompt, summary and messages), counted once per request
+    tokens: int = 0
+
+
+def input_budget(model: str) -> int:
+    limit = MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT)
+    return min(limit - OUTPUT_RESERVE_TOKENS, MAX_INPUT_TOKENS)
+
+
+def summarize(previous: str, messages: Sequence[StoredMessage], max_tokens: int) -> str:
+    """
+    Fold compacted messages into the rolling summary.
+
+    This is extractive (the opening of each message) so compaction costs no
+    extra upstream call; only the newest `max_tokens` worth is kept.
+    """
+    lines = previous.split("\n") if previous else []
+    for msg in messages:
+        text = " ".join(msg.content.split())
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS] + "..."
+        lines.append(f"{msg.role.capitalize()}: {text}")
+
+    tokens = [count_tokens(line) + 1 for line in lines]
+    total = sum(tokens)
+    start = 0
+    while start < len(lines) and total > max_tokens:
+        total -= tokens[start]
+        start += 1
+    return "\n".join(lines[start:])
+
+
+def system_text(system: SystemPrompt) -> str:
+    if isinstance(system, str):
+        return system
+    return "\n\n".join(section for section in system if section)
+
+
+def system_sections(system: SystemPrompt, summary: str) -> List[str]:
+    """`system` followed by the rolling summary, which changes more often, as sections."""
+    sections = [system] if isinstance(system, str) else list(system)
+    if summary:
+        sections.append(f"{SUMMARY_HEADER}\n{summary}")
+    return [section for section in sections if section]
+
+
+def with_summary(system: SystemPrompt, summary: str) -> str:
+    return system_text(system_sections(system, summary))
+
+
+async def build_context(key: Optional[str], user_msg: Dict[str, str], model: str, system: SystemPrompt = "") -> Context:
+    """
+    Recent history for `key` that fits the model's input budget, followed by
+    `user_msg`. A request without a conversation (`key` is None) has no history.
+
+    Turns that no longer fit are folded into the conversation's rolling
+    summary and dropped from the store. Token counts come from the store, so
+    only the new message and system prompt are counted per request.
+    """
+    system_tokens = count_tokens(system_text(system))
+    user_tokens = count_message_tokens(user_msg["content"])
+    conversation = await conversations.get(key) if key else None
+    if conversation is None:
+        return Context("", [user_msg], system_tokens + user_tokens)
+
+    budget = input_budget(model) - system_tokens - user_tokens
+    messages = conversation.messages
+    summary = conversation.summary
+    summary_tokens = conversation.summary_tokens
+    window_tokens = sum(msg.tokens for msg in messages)
+
+    if window_tokens + summary_tokens > budget:
+        summary_budget = min(SUMMARY_MAX_TOKENS, budget // 4)
+        target = int(budget * COMPACT_TARGET) - summary_budget
+        start = 0
+        while start < len(messages) and window_tokens > target:
+            window_tokens -= messages[start].tokens
+            start += 1
+        # The window has to open on a user turn (Claude rejects anything else)
+        while start < len(messages) and messages[start].role != "user":
+            window_tokens -= messages[start].tokens
+            start += 1
+
+        summary = summarize(summary, messages[:start], summary_budget)
+        summary_tokens = count_tokens(summary)
+        # Sliced before compacting: depending on the backend, `messages` is
+        # either the stored list itself or a snapshot of it
+        messages = messages[start:]
+        await conversations.compact(key, start, summary, summary_tokens)
+
+    return Context(
+        summary,
+        [msg.to_dict() for msg in messages] + [user_msg],
+        system_tokens + summary_tokens + window_tokens + user_tokens,
+    )
+
+
+def trim_messages(messages: List[Dict[str, str]], model: str, system: str = "") -> Context:
+    """Drop the oldest client-supplied messages that do not fit the budget."""
+    system_tokens = count_tokens(system)
+    budget = input_budget(model) - system_tokens
+    total = 0
+    kept = []
+    for msg in reversed(messages):
+        tokens = count_message_tokens(str(msg.get("content", "")))
+        if kept and total + tokens > budget:
+            break
+        total += tokens
+        kept.append(msg)
+    kept.reverse()
+    return Context("", kept, system_tokens + total)
@@ -0,0 +1,20 @@
+import os
+import tempfile
+
+from app.cache import TieredCache
+
+DOC_CACHE_DIR = os.getenv("DOC_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "llm_service_doc_cache")
+DOC_CACHE_MEMORY_BYTES = int(os.getenv("DOC_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+DOC_CACHE_DISK_BYTES = int(os.getenv("DOC_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+
+
+class DocumentCache(TieredCache):
+    """Extracted document text keyed by the SHA-256 of the uploaded bytes."""
+
+    def __init__(
+        self,
+        directory: str = DOC_CACHE_DIR,
+        memory_bytes: int = DOC_CACHE_MEMORY_BYTES,
+        disk_bytes: int = DOC_CACHE_DISK_BYTES,
+    ):
+        super().__init__(directory, memory_bytes, disk_bytes)
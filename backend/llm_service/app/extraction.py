@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, List, Optional
+
+import PyPDF2
+from fastapi import HTTPException, Request, UploadFile
+
+from app.doc_cache import DocumentCache
+from app.metrics import record_stage
+
+logger = logging.getLogger(__name__)
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+EXTRACT_MAX_BYTES = int(os.getenv("EXTRACT_MAX_BYTES", str(50 * 1024 * 1024)))
+EXTRACT_MAX_PAGES = int(os.getenv("EXTRACT_MAX_PAGES", "500"))
+# Smallest page range handed to one worker; below this the process hop costs
+# more than it saves
+EXTRACT_MIN_PAGES_PER_TASK = int(os.getenv("EXTRACT_MIN_PAGES_PER_TASK", "16"))
+EXTRACT_SPOOL_DIR = os.getenv("EXTRACT_SPOOL_DIR") or None
+
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class ExtractedDocument:
+    text: str
+    filename: str
+    content_type: str
+    size: int
+    pages: int
+    seconds: float
+    digest: str = ""
+    cached: bool = False
+
+
+def _spool(source: BinaryIO, max_bytes: int) -> tuple:
+    # Copy the upload to a named file so worker processes can open it, hashing
+    # it on the way for the document cache
+    source.seek(0)
+    size = 0
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=EXTRACT_SPOOL_DIR, suffix=".upload", delete=False) as out:
+        try:
+            while True:
+                chunk = source.read(SPOOL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File is larger than the {max_bytes} byte limit"
+                    )
+                digest.update(chunk)
+                out.write(chunk)
+        except BaseException:
+            out.close()
+            os.unlink(out.name)
+            raise
+    return out.name, size, digest.hexdigest()
+
+
+def _count_pages(path: str) -> int:
+    return len(PyPDF2.PdfReader(path).pages)
+
+
+def _extract_pages(path: str, start: int, stop: int) -> List[str]:
+    reader = PyPDF2.PdfReader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def _read_text(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+class DocumentExtractor:
+    """
+    Turns uploads into prompt text without blocking the event loop.
+
+    Uploads are spooled to disk and PDF pages are extracted in page ranges on
+    a bounded process pool, so a large document only ever occupies the pool
+    and not the workers serving other chats. Text of PDF and text uploads is
+    cached by content hash, so a repeated upload is never parsed twice.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = EXTRACT_WORKERS,
+        max_bytes: int = EXTRACT_MAX_BYTES,
+        max_pages: int = EXTRACT_MAX_PAGES,
+        cache: Optional[DocumentCache] = None,
+    ):
+        self.max_workers = max_workers
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self.cache = cache
+        self._pool = ProcessPoolExecutor(max_workers=max_workers)
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    async def extract(self, file: UploadFile) -> ExtractedDocument:
+        started = time.perf_counter()
+        content_type = file.content_type or ""
+        path, size, digest = await asyncio.to_thread(_spool, file.file, self.max_bytes)
+        cacheable = self.cache is not None and (
+            content_type == "application/pdf" or content_type.startswith("text/")
+        )
+        cached = None
+        try:
+            if cacheable:
+                cached = await self.cache.get(digest)
+            pages = 0
+            if cached is not None:
+                pages, text = cached["pages"], cached["text"]
+            elif content_type == "application/pdf":
+                pages, text = await self._extract_pdf(path)
+            elif content_type.startswith("text/"):
+                text = await asyncio.to_thread(_read_text, path)
+            else:
+                # For other file types, return file info
+                text = f"[File: {file.filename} (type: {content_type})]"
+        finally:
+            os.unlink(path)
+
+        if cacheable and cached is None:
+            await self.cache.put(digest, {"text": text, "pages": pages})
+
+        document = ExtractedDocument(
+            text=text,
+            filename=file.filename or "",
+            content_type=content_type,
+            size=size,
+            pages=pages,
+            seconds=time.perf_counter() - started,
+            digest=digest,
+            cached=cached is not None,
+        )
+        logger.info(
+            f"Extracted {document.filename} ({document.size} bytes, "
+            f"{document.pages} pages{', cached' if document.cached else ''}) "
+            f"in {document.seconds:.3f}s"
+        )
+        return document
+
+    async def _extract_pdf(self, path: str) -> tuple:
+        loop = asyncio.get_running_loop()
+        pages = await loop.run_in_executor(self._pool, _count_pages, path)
+        if pages > self.max_pages:
+            raise HTTPException(
+                status_code=413,
+                detail=f"PDF has {pages} pages, the limit is {self.max_pages}"
+            )
+
+        per_task = max(EXTRACT_MIN_PAGES_PER_TASK, math.ceil(pages / self.max_workers))
+        tasks = [
+            loop.run_in_executor(self._pool, _extract_pages, path, start, min(start + per_task, pages))
+            for start in range(0, pages, per_task)
+        ]
+        ranges = await asyncio.gather(*tasks)
+        # One join over all pages instead of growing a string page by page
+        return pages, "".join(page + "\n" for page_range in ranges for page in page_range)
+
+
+def get_extractor(request: Request) -> DocumentExtractor:
+    return request.app.state.extractor
+
+
+def server_timing(document: Optional[ExtractedDocument]) -> dict:
+    if document is None:
+        return {}
+    description = ';desc="cached"' if document.cached else ""
+    return {"Server-Timing": f"extract;dur={document.seconds * 1000:.1f}{description}"}
+
+
+async def extract_upload(file: Optional[UploadFile], extractor: DocumentExtractor) -> Optional[ExtractedDocument]:
+    """Extract the upload, if any, turning parse errors into a 400."""
+    if not file:
+        return None
+    try:
+        document = await extractor.extract(file)
+    except HTTPException:
+        raise
+    except Exception as file_error:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Error processing file: {str(file_error)}"
+        )
+    record_stage("extract", document.seconds)
+    return document
@@ -0,0 +1,401 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+from app.tokens import count_message_tokens
+
+logger = logging.getLogger(__name__)
+
+# "memory" keeps history inside the process; "sqlite" shares it between
+# worker processes through a database file
+CONVERSATION_BACKEND = os.getenv("CONVERSATION_BACKEND", "memory")
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH") or os.path.join(
+    tempfile.gettempdir(), "llm_service_conversations.db"
+)
+
+# Conversations are evicted least-recently-used first once either limit is hit
+CONVERSATION_MAX_BYTES = int(os.getenv("CONVERSATION_MAX_BYTES", str(256 * 1024 * 1024)))
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", str(24 * 60 * 60)))
+
+# Rough per-message cost of the object itself, on top of the content string
+MESSAGE_OVERHEAD = 64
+
+
+def _text_size(text: str) -> int:
+    return sys.getsizeof(text) if text else 0
+
+
+@dataclass(frozen=True)
+class StoredMessage:
+    __slots__ = ("role", "content", "tokens")
+
+    role: str
+    content: str
+    # Counted once when the message is stored, never again
+    tokens: int
+
+    @property
+    def size(self) -> int:
+        return sys.getsizeof(self.content) + MESSAGE_OVERHEAD
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+
+class Conversation:
+    __slots__ = ("messages", "summary", "summary_tokens", "size", "last_access", "documents")
+
+    def __init__(
+        self,
+        messages: Optional[List[StoredMessage]] = None,
+        summary: str = "",
+        summary_tokens: int = 0,
+        size: int = 0,
+        last_access: Optional[float] = None,
+        documents: Optional[List[str]] = None,
+    ):
+        self.messages = messages if messages is not None else []
+        # Rolling summary of the turns that have been compacted out of `messages`
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        self.size = size
+        self.last_access = last_access if last_access is not None else time.monotonic()
+        # Digests of the documents uploaded to this conversation
+        self.documents = documents if documents is not None else []
+
+
+class ConversationStore:
+    """
+    In-process history for all conversations, keyed by conversation id.
+
+    Clients only send the newest message; the store supplies the rest.
+    Idle conversations expire after `ttl` seconds and the least recently
+    used ones are dropped when the total size goes over `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = CONVERSATION_MAX_BYTES, ttl: float = CONVERSATION_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def _get(self, conversation_id: str) -> Optional[Conversation]:
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            return None
+        now = time.monotonic()
+        if now - conversation.last_access > self.ttl:
+            self._clear(conversation_id)
+            return None
+        conversation.last_access = now
+        self._conversations.move_to_end(conversation_id)
+        return conversation
+
+    async def get(self, conversation_id: str) -> Optional[Conversation]:
+        return self._get(conversation_id)
+
+    async def messages(self, conversation_id: str) -> List[Dict[str, str]]:
+        conversation = self._get(conversation_id)
+        if conversation is None:
+            return []
+        return [msg.to_dict() for msg in conversation.messages]
+
+    async def documents(self, conversation_id: str) -> List[str]:
+        conversation = self._get(conversation_id)
+        return list(conversation.documents) if conversation is not None else []
+
+    async def append(self, conversation_id: str, *messages: Dict[str, str], documents: Sequence[str] = ()):
+        """Add `messages`, and attach `documents` (digests) to the conversation."""
+        conversation = self._get(conversation_id)
+        if conversation is None:
+            conversation = Conversation()
+            self._conversations[conversation_id] = conversation
+        for digest in documents:
+            if digest not in conversation.documents:
+                conversation.documents.append(digest)
+        for msg in messages:
+            stored = StoredMessage(
+                sys.intern(msg["role"]),
+                msg["content"],
+                count_message_tokens(msg["content"])
+            )
+            conversation.messages.append(stored)
+            conversation.size += stored.size
+            self.size += stored.size
+        self._evict()
+
+    async def compact(self, conversation_id: str, count: int, summary: str, summary_tokens: int):
+        """Replace the oldest `count` messages with an updated summary."""
+        conversation = self._get(conversation_id)
+        if conversation is None:
+            return
+        dropped = conversation.messages[:count]
+        del conversation.messages[:count]
+        freed = sum(msg.size for msg in dropped) + _text_size(conversation.summary)
+        added = _text_size(summary)
+        conversation.summary = summary
+        conversation.summary_tokens = summary_tokens
+        conversation.size += added - freed
+        self.size += added - freed
+
+    async def clear(self, conversation_id: str):
+        self._clear(conversation_id)
+
+    def _clear(self, conversation_id: str):
+        conversation = self._conversations.pop(conversation_id, None)
+        if conversation is not None:
+            self.size -= conversation.size
+
+    def _evict(self):
+        now = time.monotonic()
+        # Oldest entries sit at the front, so stop at the first live one. The
+        # most recent conversation is always kept, even if it is over budget
+        while len(self._conversations) > 1:
+            conversation_id, conversation = next(iter(self._conversations.items()))
+            if self.size <= self.max_bytes and now - conversation.last_access <= self.ttl:
+                break
+            self._clear(conversation_id)
+
+
+class SQLiteConversationStore:
+    """
+    History in a SQLite database, shared by every worker process on the host.
+
+    Same interface and limits as `ConversationStore`, so any worker can
+    continue any conversation. The database runs in WAL mode, which lets
+    readers proceed while another process writes; a turn costs one short
+    write transaction, which is also when `last_access` is refreshed.
+    Queries run on worker threads, each with its own connection, so waiting
+    on another process's write never blocks the event loop. Sizes are
+    content bytes rather than Python object sizes.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL DEFAULT '',
+            summary_tokens INTEGER NOT NULL DEFAULT 0,
+            size INTEGER NOT NULL DEFAULT 0,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS conversations_last_access ON conversations (last_access);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            conversation_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation_id, id);
+        CREATE TABLE IF NOT EXISTS documents (
+            conversation_id TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (conversation_id, digest)
+        );
+    """
+
+    # Eviction scans the whole table, so each process runs it at most this often
+    EVICT_INTERVAL = 30.0
+
+    def __init__(self, path: str = CONVERSATION_DB_PATH, max_bytes: int = CONVERSATION_MAX_BYTES, ttl: float = CONVERSATION_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._evict_lock = threading.Lock()
+        self._last_evict = 0.0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # One connection per thread; connections must not cross a fork either
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            # Durable up to the last checkpoint; history is not worth an fsync per turn
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(self.SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM conversations").fetchone()[0]
+
+    def _row(self, conversation_id: str) -> Optional[sqlite3.Row]:
+        # Read-only: expired conversations look absent until eviction removes them
+        row = self.db.execute(
+            "SELECT summary, summary_tokens, size, last_access FROM conversations WHERE id = ?",
+            (conversation_id,),
+        ).fetchone()
+        # Wall clock rather than monotonic, since the timestamps are shared between processes
+        if row is None or time.time() - row[3] > self.ttl:
+            return None
+        return row
+
+    def _get(self, conversation_id: str) -> Optional[Conversation]:
+        row = self._row(conversation_id)
+        if row is None:
+            return None
+        messages = [
+            StoredMessage(sys.intern(role), content, tokens)
+            for role, content, tokens in self.db.execute(
+                "SELECT role, content, tokens FROM messages WHERE conversation_id = ? ORDER BY id",
+                (conversation_id,),
+            )
+        ]
+        return Conversation(messages, row[0], row[1], row[2], row[3])
+
+    def _documents(self, conversation_id: str) -> List[str]:
+        if self._row(conversation_id) is None:
+            return []
+        return [
+            digest for digest, in self.db.execute(
+                "SELECT digest FROM documents WHERE conversation_id = ? ORDER BY rowid", (conversation_id,)
+            )
+        ]
+
+    def _append(self, conversation_id: str, messages: Sequence[Dict[str, str]], documents: Sequence[str]):
+        rows = [
+            (conversation_id, msg["role"], msg["content"], count_message_tokens(msg["content"]))
+            for msg in messages
+        ]
+        added = sum(len(content.encode()) + MESSAGE_OVERHEAD for _, _, content, _ in rows)
+        now = time.time()
+        db = self.db
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT last_access FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+            if row is not None and now - row[0] > self.ttl:
+                # Expired but not evicted yet; start the conversation afresh
+                self._delete(db, conversation_id)
+            db.execute(
+                "INSERT INTO conversations (id, size, last_access) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET size = size + excluded.size, last_access = excluded.last_access",
+                (conversation_id, added, now),
+            )
+            db.executemany("INSERT INTO messages (conversation_id, role, content, tokens) VALUES (?, ?, ?, ?)", rows)
+            db.executemany(
+                "INSERT OR IGNORE INTO documents (conversation_id, digest) VALUES (?, ?)",
+                [(conversation_id, digest) for digest in documents],
+            )
+        self._evict()
+
+    def _compact(self, conversation_id: str, count: int, summary: str, summary_tokens: int):
+        db = self.db
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT summary FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+            if row is None:
+                return
+            dropped = db.execute(
+                "SELECT id, LENGTH(CAST(content AS BLOB)) FROM messages WHERE conversation_id = ? ORDER BY id LIMIT ?",
+                (conversation_id, count),
+            ).fetchall()
+            if dropped:
+                db.execute("DELETE FROM messages WHERE conversation_id = ? AND id <= ?", (conversation_id, dropped[-1][0]))
+            freed = sum(size + MESSAGE_OVERHEAD for _, size in dropped) + len(row[0].encode())
+            db.execute(
+                "UPDATE conversations SET summary = ?, summary_tokens = ?, size = size + ? WHERE id = ?",
+                (summary, summary_tokens, len(summary.encode()) - freed, conversation_id),
+            )
+
+    @staticmethod
+    def _delete(db: sqlite3.Connection, conversation_id: str):
+        db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+        db.execute("DELETE FROM documents WHERE conversation_id = ?", (conversation_id,))
+        db.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+    def _clear(self, conversation_id: str):
+        db = self.db
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            self._delete(db, conversation_id)
+
+    def _evict(self):
+        now = time.time()
+        with self._evict_lock:
+            if now - self._last_evict < self.EVICT_INTERVAL:
+                return
+            self._last_evict = now
+        db = self.db
+        expired = [
+            conversation_id for conversation_id, in db.execute(
+                "SELECT id FROM conversations WHERE last_access < ?", (now - self.ttl,)
+            )
+        ]
+        over = self.size - self.max_bytes
+        if over > 0:
+            # Oldest first, always keeping the most recent conversation
+            for conversation_id, size in db.execute(
+                "SELECT id, size FROM conversations WHERE last_access >= ? ORDER BY last_access",
+                (now - self.ttl,),
+            ).fetchall()[:-1]:
+                if over <= 0:
+                    break
+                expired.append(conversation_id)
+                over -= size
+        for conversation_id in expired:
+            self._clear(conversation_id)
+        if expired:
+            logger.info(f"Evicted {len(expired)} conversations")
+
+    async def get(self, conversation_id: str) -> Optional[Conversation]:
+        return await asyncio.to_thread(self._get, conversation_id)
+
+    async def messages(self, conversation_id: str) -> List[Dict[str, str]]:
+        conversation = await self.get(conversation_id)
+        if conversation is None:
+            return []
+        return [msg.to_dict() for msg in conversation.messages]
+
+    async def documents(self, conversation_id: str) -> List[str]:
+        return await asyncio.to_thread(self._documents, conversation_id)
+
+    async def append(self, conversation_id: str, *messages: Dict[str, str], documents: Sequence[str] = ()):
+        """Add `messages`, and attach `documents` (digests) to the conversation."""
+        await asyncio.to_thread(self._append, conversation_id, messages, documents)
+
+    async def compact(self, conversation_id: str, count: int, summary: str, summary_tokens: int):
+        """Replace the oldest `count` messages with an updated summary."""
+        await asyncio.to_thread(self._compact, conversation_id, count, summary, summary_tokens)
+
+    async def clear(self, conversation_id: str):
+        await asyncio.to_thread(self._clear, conversation_id)
+
+
+def open_conversation_store(backend: str = CONVERSATION_BACKEND):
+    if backend == "memory":
+        return ConversationStore()
+    if backend == "sqlite":
+        return SQLiteConversationStore()
+    raise ValueError(f"Unknown CONVERSATION_BACKEND: {backend}")
+
+
+def conversation_key(provider: str, conversation_id: Optional[str]) -> Optional[str]:
+    """
+    Store key for a conversation, or None without an id: such requests are
+    stateless, since a history shared by every caller would leak between them.
+    """
+    if not conversation_id:
+        return None
+    return f"{provider}:{conversation_id}"
+
+
+# Shared by all routers; each provider keeps its own history per conversation
+conversations = open_conversation_store()
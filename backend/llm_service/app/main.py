@@ -1,21 +1,52 @@
+import argparse
+import logging
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from app.clients import ProviderClients, build_http_client
+from app.blobs import BlobStore
+from app.extraction import DocumentExtractor
+from app.doc_cache import DocumentCache
+from app.retrieval import DocumentLibrary
+from app.response_cache import RESPONSE_CACHE_ENABLED, ResponseCache
 from app.routes.gpt import router
 from app.routes.Llama import llamaRouter 
 from app.routes.claude import claudeRouter
-from pydantic import BaseModel
+from app.routes.images import imagesRouter
+from app.routes.batch import batchRouter, batch_semaphores
+from app.coalesce import Coalescer
+from app.cancellation import ArrivalMiddleware
+from app.providers import ProviderRegistry
+from app.metrics import UPSTREAM_QUEUED, JSONResponse, MetricsMiddleware, render
 import uvicorn
-from fastapi.staticfiles import StaticFiles
-import os
 
-SYSTEM_MESSAGE = "Make sure you are kind, welcoming, accurate and precise in responding towards the prompts of the user. If asked about code, return beautiful code formatting"
+logger = logging.getLogger(__name__)
 
-class GenerateRequest(BaseModel):
-    prompt: str
-    temperature: float = 0.7
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One long-lived async client per provider, shared by every router so
+    # upstream connections stay pooled and kept alive between requests
+    app.state.clients = ProviderClients.from_env()
+    app.state.providers = ProviderRegistry(app.state.clients)
+    app.state.extractor = DocumentExtractor(cache=DocumentCache())
+    app.state.documents = DocumentLibrary(app.state.extractor)
+    app.state.response_cache = ResponseCache() if RESPONSE_CACHE_ENABLED else None
+    # Plain HTTP client for downloads that are not provider API calls
+    app.state.http = build_http_client()
+    app.state.blobs = BlobStore(app.state.http)
+    app.state.batch_semaphores = batch_semaphores()
+    app.state.coalescer = Coalescer()
+    try:
+        yield
+    finally:
+        app.state.extractor.close()
+        await app.state.http.aclose()
+        await app.state.clients.close()
 
 # Initialize FastAPI app
-app = FastAPI(title="LLM Service")
+app = FastAPI(title="LLM Service", lifespan=lifespan, default_response_class=JSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -31,10 +62,61 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request deadlines count from here
+app.add_middleware(ArrivalMiddleware)
+
+# Outermost, so request latency covers everything the service does
+app.add_middleware(MetricsMiddleware)
+
+@app.get("/stats")
+async def stats():
+    response_cache = app.state.response_cache
+    return {
+        "document_cache": app.state.extractor.cache.stats(),
+        "document_index": app.state.documents.cache.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "coalescer": app.state.coalescer.stats(),
+        "providers": app.state.providers.stats(),
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    for name, provider in app.state.providers.providers.items():
+        UPSTREAM_QUEUED.set(provider.scheduler.stats()["queued"], provider=name)
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
 # Include routers
 app.include_router(router)
 app.include_router(llamaRouter)
 app.include_router(claudeRouter)
+app.include_router(imagesRouter)
+app.include_router(batchRouter)
+
+def serve():
+    """
+    Run the service: `python -m app.main` for production, with one worker
+    per CPU core (or `WEB_CONCURRENCY`), or `python -m app.main --dev` for a
+    single reloading worker.
+    """
+    parser = argparse.ArgumentParser(description="Run the LLM service")
+    parser.add_argument("--dev", action="store_true", help="Single worker with auto-reload")
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "0")) or os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    workers = 1 if args.dev else args.workers
+    if workers > 1:
+        # Workers only share what lives outside the process
+        backend = os.environ.setdefault("CONVERSATION_BACKEND", "sqlite")
+        if backend == "memory":
+            raise SystemExit("CONVERSATION_BACKEND=memory cannot be shared between workers; use sqlite or --workers 1")
+    # Read by every worker to split the per-provider admission limits
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+
+    logger.info(f"Starting {workers} worker(s) on {args.host}:{args.port}")
+    uvicorn.run("app.main:app", host=args.host, port=args.port, workers=workers, reload=args.dev)
+
 
-if __name__ == "_main_":
-    uvicorn.run("main:app", host="localhost", port=8000, reload=True)
\ No newline at end of file
+if __name__ == "__main__":
+    serve()
\ No newline at end of file
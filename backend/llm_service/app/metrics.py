@@ -0,0 +1,236 @@
+import bisect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi.responses import JSONResponse as _JSONResponse
+from starlette.routing import Match
+
+# Seconds; upstream calls can run for minutes, local stages for milliseconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))  # 256 B .. 64 MB
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144)
+
+_METRICS: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        _METRICS.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_number(value)}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Per-bucket counts (last one is +Inf), then sum
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def _samples(self) -> Iterator[str]:
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_number(bound)
+                labels = _format_labels(self.labels, key, f'le="{le}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {_format_number(total)}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in _METRICS) + "\n"
+
+
+REQUESTS = Counter("llm_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+REQUEST_SECONDS = Histogram("llm_http_request_duration_seconds", "Time until the response finished sending", ("method", "route"))
+REQUESTS_IN_FLIGHT = Gauge("llm_http_requests_in_flight", "HTTP requests being handled", ("route",))
+REQUEST_BYTES = Histogram("llm_http_request_size_bytes", "Request body size", ("route",), SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram("llm_http_response_size_bytes", "Response body size", ("route",), SIZE_BUCKETS)
+STAGE_SECONDS = Histogram(
+    "llm_http_request_stage_seconds",
+    "Time spent per request in each stage: upstream, queue, extract, serialize, and other local work",
+    ("route", "stage"),
+)
+
+UPSTREAM_SECONDS = Histogram("llm_upstream_duration_seconds", "Upstream call latency", ("provider", "outcome"))
+UPSTREAM_TTFT_SECONDS = Histogram(
+    "llm_upstream_ttft_seconds", "Upstream time to first token of streamed calls", ("route", "provider")
+)
+UPSTREAM_IN_FLIGHT = Gauge("llm_upstream_in_flight", "Upstream calls in flight", ("provider",))
+UPSTREAM_QUEUED = Gauge("llm_upstream_queued", "Calls waiting for admission", ("provider",))
+TOKENS = Counter("llm_tokens_total", "Tokens reported by the upstream: prompt (cached included), completion, cache_read, cache_write", ("provider", "type"))
+COMPLETION_TOKENS = Histogram("llm_completion_tokens", "Completion tokens per upstream call", ("provider",), TOKEN_BUCKETS)
+
+# Per-request stage timings; a fresh dict is installed by the middleware
+_stages: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_stages", default=None)
+# Route template of the current request, for metrics recorded outside the middleware
+_route: ContextVar[str] = ContextVar("request_route", default="none")
+
+
+def current_route() -> str:
+    return _route.get()
+
+
+def record_stage(stage: str, seconds: float):
+    """Add `seconds` to `stage` of the current request, if there is one."""
+    stages = _stages.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed_stage(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def record_usage(provider: str, usage: Optional[Dict[str, int]]):
+    if not usage:
+        return
+    TOKENS.inc(usage.get("prompt_tokens", 0), provider=provider, type="prompt")
+    TOKENS.inc(usage.get("completion_tokens", 0), provider=provider, type="completion")
+    for kind in ("cache_read", "cache_write"):
+        if f"{kind}_tokens" in usage:
+            TOKENS.inc(usage[f"{kind}_tokens"], provider=provider, type=kind)
+    COMPLETION_TOKENS.observe(usage.get("completion_tokens", 0), provider=provider)
+
+
+class JSONResponse(_JSONResponse):
+    """JSONResponse that counts its own rendering as the request's serialize stage."""
+
+    def render(self, content: Any) -> bytes:
+        with timed_stage("serialize"):
+            return super().render(content)
+
+
+def _route_path(scope) -> str:
+    # Label by route template, never by raw path, to keep label values bounded
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """Records request count, latency, sizes, in-flight requests and a stage breakdown per route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = _route_path(scope)
+        method = scope["method"]
+        stages: Dict[str, float] = {}
+        token = _stages.set(stages)
+        route_token = _route.set(route)
+        status = 500
+        request_bytes = 0
+        response_bytes = 0
+
+        async def counting_receive():
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                request_bytes += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(route=route)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - started
+            _stages.reset(token)
+            _route.reset(route_token)
+            REQUESTS_IN_FLIGHT.dec(route=route)
+            REQUESTS.inc(method=method, route=route, status=status)
+            REQUEST_SECONDS.observe(elapsed, method=method, route=route)
+            REQUEST_BYTES.observe(request_bytes, route=route)
+            RESPONSE_BYTES.observe(response_bytes, route=route)
+            for stage, seconds in stages.items():
+                STAGE_SECONDS.observe(seconds, route=route, stage=stage)
+            # Whatever is not accounted for is framework, validation and I/O
+            STAGE_SECONDS.observe(max(0.0, elapsed - sum(stages.values())), route=route, stage="other")
@@ -0,0 +1,554 @@
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Literal, Optional
+
+import anthropic
+import groq
+import openai
+from fastapi import HTTPException, Request
+
+from app.admission import INTERACTIVE, Scheduler, provider_limits
+from app.clients import ProviderClients
+from app.context import OUTPUT_RESERVE_TOKENS, SystemPrompt, input_budget, system_text
+from app.metrics import (
+    UPSTREAM_IN_FLIGHT,
+    UPSTREAM_SECONDS,
+    UPSTREAM_TTFT_SECONDS,
+    current_route,
+    record_stage,
+    record_usage,
+)
+from app.streaming import (
+    StreamItem,
+    StreamModel,
+    anthropic_token_stream,
+    anthropic_usage,
+    openai_token_stream,
+    openai_usage,
+)
+from app.tokens import count_message_tokens, count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Model each provider name maps to
+PROVIDER_MODELS = {
+    "gpt": os.getenv("GPT_MODEL", "gpt-4"),
+    "claude": os.getenv("CLAUDE_MODEL", "claude-sonnet-4-20250514"),
+    "llama": os.getenv("LLAMA_MODEL", "llama-3.3-70b-versatile"),
+}
+
+CLAUDE_MAX_TOKENS = 1024
+
+# Mark stable prompt prefixes as cacheable in Anthropic requests
+CLAUDE_PROMPT_CACHING = os.getenv("CLAUDE_PROMPT_CACHING", "true").lower() in ("1", "true", "yes")
+# Anthropic allows four breakpoints; the last system sections take these and
+# the end of the history one more
+CLAUDE_SYSTEM_BREAKPOINTS = 2
+EPHEMERAL = {"type": "ephemeral"}
+
+# How many recent calls the rolling latency and error stats cover
+STATS_WINDOW = int(os.getenv("PROVIDER_STATS_WINDOW", "200"))
+# Calls needed before a provider's own percentiles are trusted
+STATS_MIN_SAMPLES = 20
+# Fixed hedge delay in ms; when unset, the primary's p95 is used
+HEDGE_DELAY_MS = os.getenv("HEDGE_DELAY_MS")
+DEFAULT_HEDGE_DELAY = 2.0
+
+# "default" always answers with the requested provider; "fast" may hedge to another
+Routing = Literal["default", "fast"]
+
+_TIMEOUT_ERRORS = (openai.APITimeoutError, anthropic.APITimeoutError, groq.APITimeoutError)
+_RATE_LIMIT_ERRORS = (openai.RateLimitError, anthropic.RateLimitError, groq.RateLimitError)
+_CONNECTION_ERRORS = (openai.APIConnectionError, anthropic.APIConnectionError, groq.APIConnectionError)
+_STATUS_ERRORS = (openai.APIStatusError, anthropic.APIStatusError, groq.APIStatusError)
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Seconds the upstream asked us to back off for, if it said."""
+    response = getattr(e, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, ValueError):
+        return None
+
+
+def upstream_error(e: Exception, message: str = "Error generating response") -> HTTPException:
+    """Map a provider SDK error onto the HTTP status it deserves, rather than a blanket 500."""
+    if isinstance(e, HTTPException):
+        return e
+    headers = None
+    if isinstance(e, _TIMEOUT_ERRORS):
+        status_code = 504
+    elif isinstance(e, _RATE_LIMIT_ERRORS):
+        status_code = 429
+        headers = {"Retry-After": str(round(retry_after(e) or 1))}
+    elif isinstance(e, _CONNECTION_ERRORS):
+        status_code = 502
+    elif isinstance(e, _STATUS_ERRORS) and e.status_code >= 500:
+        status_code = 502
+    else:
+        status_code = 500
+    return HTTPException(status_code=status_code, detail=f"{message}: {str(e)}", headers=headers)
+
+
+@dataclass
+class Completion:
+    text: str
+    model: str
+    usage: Dict[str, int] = field(default_factory=dict)
+
+
+class LatencyStats:
+    """Rolling latency percentiles and error rate over the last `window` calls."""
+
+    def __init__(self, window: int = STATS_WINDOW):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float, ok: bool = True):
+        self._samples.append((seconds, ok))
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        latencies = sorted(seconds for seconds, ok in self._samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    @property
+    def error_rate(self) -> float:
+        if not self._samples:
+            return 0.0
+        return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+
+    def snapshot(self) -> Dict[str, Optional[float]]:
+        return {
+            "samples": len(self._samples),
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "error_rate": self.error_rate,
+        }
+
+
+class Provider(ABC):
+    """One upstream chat backend, with its own admission control and rolling stats."""
+
+    name: str = ""
+    # Tokens a reply is assumed to use until the real usage is known
+    output_estimate: int = OUTPUT_RESERVE_TOKENS
+
+    def __init__(self, client, model: str):
+        self.client = client
+        self.model = model
+        self.scheduler = Scheduler(self.name, **provider_limits(self.name))
+        self.latency = LatencyStats()
+        # Time to first token of streamed calls
+        self.ttft = LatencyStats()
+
+    def count_prompt_tokens(self, messages: List[Dict[str, str]], system: Optional[SystemPrompt]) -> int:
+        prompt = sum(count_message_tokens(str(msg["content"])) for msg in messages)
+        return prompt + count_tokens(system_text(system or ""))
+
+    def estimate_tokens(
+        self,
+        messages: List[Dict[str, str]],
+        system: Optional[SystemPrompt],
+        prompt_tokens: Optional[int] = None,
+    ) -> int:
+        """Tokens the call is admitted for; `prompt_tokens` spares recounting a prompt already counted."""
+        if prompt_tokens is None:
+            prompt_tokens = self.count_prompt_tokens(messages, system)
+        return prompt_tokens + self.output_estimate
+
+    def _failed(self, e: Exception):
+        if isinstance(e, _RATE_LIMIT_ERRORS):
+            # Let the upstream recover instead of queueing more calls into its 429s
+            self.scheduler.throttle(retry_after(e))
+
+    @asynccontextmanager
+    async def _admitted(self, estimate: int, priority: int):
+        """Hold an admission slot, recording time spent queueing for it."""
+        queued = time.perf_counter()
+        async with self.scheduler.slot(estimate, priority):
+            record_stage("queue", time.perf_counter() - queued)
+            UPSTREAM_IN_FLIGHT.inc(provider=self.name)
+            try:
+                yield
+            finally:
+                UPSTREAM_IN_FLIGHT.dec(provider=self.name)
+
+    def _finished(self, started: float, ok: bool, stats: Optional[LatencyStats] = None):
+        seconds = time.perf_counter() - started
+        (stats or self.latency).record(seconds, ok=ok)
+        UPSTREAM_SECONDS.observe(seconds, provider=self.name, outcome="ok" if ok else "error")
+        record_stage("upstream", seconds)
+
+    @abstractmethod
+    async def _complete(self, messages, temperature, system) -> Completion:
+        """One upstream call, without admission control or stats."""
+
+    @abstractmethod
+    def _stream(self, messages, temperature, system) -> AsyncIterator[StreamItem]:
+        """One upstream streamed call, without admission control or stats."""
+
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        system: Optional[SystemPrompt] = None,
+        priority: int = INTERACTIVE,
+        prompt_tokens: Optional[int] = None,
+    ) -> Completion:
+        estimate = self.estimate_tokens(messages, system, prompt_tokens)
+        async with self._admitted(estimate, priority):
+            # Latency is measured from admission, so queueing does not skew hedging
+            started = time.perf_counter()
+            try:
+                completion = await self._complete(messages, temperature, system)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._finished(started, ok=False)
+                self._failed(e)
+                raise
+            self._finished(started, ok=True)
+            self.scheduler.settle(estimate, completion.usage.get("total_tokens"))
+            record_usage(self.name, completion.usage)
+        return completion
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        system: Optional[SystemPrompt] = None,
+        priority: int = INTERACTIVE,
+        prompt_tokens: Optional[int] = None,
+    ) -> AsyncIterator[StreamItem]:
+        estimate = self.estimate_tokens(messages, system, prompt_tokens)
+        async with self._admitted(estimate, priority):
+            started = time.perf_counter()
+            first = True
+            try:
+                async for item in self._stream(messages, temperature, system):
+                    if first:
+                        ttft = time.perf_counter() - started
+                        self.ttft.record(ttft)
+                        UPSTREAM_TTFT_SECONDS.observe(ttft, route=current_route(), provider=self.name)
+                        first = False
+                    if isinstance(item, dict):
+                        self.scheduler.settle(estimate, item.get("total_tokens"))
+                        record_usage(self.name, item)
+                    yield item
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception as e:
+                self._finished(started, ok=False, stats=self.ttft if first else None)
+                self._failed(e)
+                raise
+            self._finished(started, ok=True)
+
+
+class OpenAIProvider(Provider):
+    name = "gpt"
+
+    def _with_system(self, messages, system):
+        if system:
+            return [{"role": "system", "content": system_text(system)}] + messages
+        return messages
+
+    async def _complete(self, messages, temperature, system) -> Completion:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=self._with_system(messages, system),
+            temperature=temperature
+        )
+        usage = {}
+        if response.usage is not None:
+            usage = openai_usage(response.usage)
+        return Completion(response.choices[0].message.content, self.model, usage)
+
+    def _stream(self, messages, temperature, system) -> AsyncIterator[StreamItem]:
+        return openai_token_stream(
+            self.client,
+            model=self.model,
+            messages=self._with_system(messages, system),
+            temperature=temperature,
+            extra_body={"stream_options": {"include_usage": True}}
+        )
+
+
+class GroqProvider(OpenAIProvider):
+    name = "llama"
+
+    def _stream(self, messages, temperature, system) -> AsyncIterator[StreamItem]:
+        # Groq reports usage on its own, without stream_options
+        return openai_token_stream(
+            self.client,
+            model=self.model,
+            messages=self._with_system(messages, system),
+            temperature=temperature
+        )
+
+
+class AnthropicProvider(Provider):
+    name = "claude"
+    output_estimate = CLAUDE_MAX_TOKENS
+
+    def _system_blocks(self, system: SystemPrompt) -> List[dict]:
+        sections = [section for section in ([system] if isinstance(system, str) else system) if section]
+        blocks = [{"type": "text", "text": section} for section in sections]
+        # Sections run from most to least stable, so when a later one changes
+        # (a new summary) the cache entry ending at an earlier one still hits
+        for block in blocks[-CLAUDE_SYSTEM_BREAKPOINTS:]:
+            block["cache_control"] = EPHEMERAL
+        return blocks
+
+    def _cached_messages(self, messages: List[Dict[str, str]]) -> List[dict]:
+        if len(messages) < 2 or not isinstance(messages[-2]["content"], str):
+            return messages
+        # Everything before the new user turn is history, sent unchanged next
+        # turn; a breakpoint there writes the prefix the next turn reads
+        last = messages[-2]
+        marked = {
+            "role": last["role"],
+            "content": [{"type": "text", "text": last["content"], "cache_control": EPHEMERAL}],
+        }
+        return messages[:-2] + [marked, messages[-1]]
+
+    def _params(self, messages, temperature, system) -> dict:
+        params = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": CLAUDE_MAX_TOKENS,
+        }
+        if CLAUDE_PROMPT_CACHING:
+            params["messages"] = self._cached_messages(messages)
+            blocks = self._system_blocks(system or "")
+            if blocks:
+                params["system"] = blocks
+        elif system:
+            params["system"] = system_text(system)
+        return params
+
+    async def _complete(self, messages, temperature, system) -> Completion:
+        response = await self.client.messages.create(**self._params(messages, temperature, system))
+        return Completion(response.content[0].text, self.model, anthropic_usage(response.usage))
+
+    def _stream(self, messages, temperature, system) -> AsyncIterator[StreamItem]:
+        return anthropic_token_stream(self.client, **self._params(messages, temperature, system))
+
+
+class ProviderRegistry:
+    """
+    All configured providers, plus latency-aware routing between them.
+
+    `complete_fast`/`stream_fast` send the request to the chosen provider and,
+    if it has not answered within the hedge delay (or fails), send a duplicate
+    to the healthiest other provider. The first answer wins and the other call
+    is cancelled.
+    """
+
+    def __init__(self, clients: ProviderClients):
+        self.providers: Dict[str, Provider] = {}
+        if clients.openai is not None:
+            self.providers["gpt"] = OpenAIProvider(clients.openai, PROVIDER_MODELS["gpt"])
+        if clients.anthropic is not None:
+            self.providers["claude"] = AnthropicProvider(clients.anthropic, PROVIDER_MODELS["claude"])
+        if clients.groq is not None:
+            self.providers["llama"] = GroqProvider(clients.groq, PROVIDER_MODELS["llama"])
+
+    def get(self, name: str) -> Provider:
+        provider = self.providers.get(name)
+        if provider is None:
+            if name not in PROVIDER_MODELS:
+                raise HTTPException(status_code=400, detail=f"Unknown provider: {name}")
+            raise HTTPException(status_code=500, detail=f"Provider {name} is not configured")
+        return provider
+
+    def check(self, name: str) -> Provider:
+        """Resolve provider `name`, rejecting now with 429 if its queue is full."""
+        provider = self.get(name)
+        provider.scheduler.check()
+        return provider
+
+    def _score(self, provider: Provider, streaming: bool) -> float:
+        stats = provider.ttft if streaming else provider.latency
+        p95 = stats.percentile(0.95) if len(stats) >= STATS_MIN_SAMPLES else None
+        # Unknown latency ranks as average; errors push a provider down hard
+        return (p95 if p95 is not None else DEFAULT_HEDGE_DELAY) * (1 + 10 * stats.error_rate)
+
+    def alternates(self, primary: Provider, streaming: bool = False, prompt_tokens: int = 0) -> List[Provider]:
+        """Other providers whose model can take a `prompt_tokens` prompt, best first."""
+        others = [
+            p for p in self.providers.values()
+            if p is not primary and input_budget(p.model) >= prompt_tokens
+        ]
+        return sorted(others, key=lambda p: self._score(p, streaming))
+
+    def hedge_delay(self, provider: Provider, streaming: bool = False) -> float:
+        if HEDGE_DELAY_MS:
+            return float(HEDGE_DELAY_MS) / 1000
+        stats = provider.ttft if streaming else provider.latency
+        p95 = stats.percentile(0.95) if len(stats) >= STATS_MIN_SAMPLES else None
+        return p95 if p95 is not None else DEFAULT_HEDGE_DELAY
+
+    async def complete_fast(
+        self,
+        primary: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        system: Optional[SystemPrompt] = None,
+        priority: int = INTERACTIVE,
+        prompt_tokens: Optional[int] = None,
+    ) -> Completion:
+        provider = self.get(primary)
+        # Counted once here and shared by both candidates
+        if prompt_tokens is None:
+            prompt_tokens = provider.count_prompt_tokens(messages, system)
+        # The prompt was budgeted for the primary's model; a backup with a
+        # smaller context window would reject it
+        backup = next(iter(self.alternates(provider, prompt_tokens=prompt_tokens)), None)
+        tasks = [asyncio.create_task(provider.complete(messages, temperature, system, priority, prompt_tokens))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(provider))
+            if backup is not None and (not done or tasks[0].exception() is not None):
+                logger.info(f"Hedging {provider.name} request to {backup.name}")
+                tasks.append(asyncio.create_task(backup.complete(messages, temperature, system, priority, prompt_tokens)))
+
+            error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream_fast(
+        self,
+        primary: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        system: Optional[SystemPrompt] = None,
+        priority: int = INTERACTIVE,
+        prompt_tokens: Optional[int] = None,
+    ) -> AsyncIterator[StreamItem]:
+        """
+        Like `complete_fast`, but hedging on time to first token. The stream
+        opens with a `StreamModel` naming the model that won.
+        """
+        provider = self.get(primary)
+        if prompt_tokens is None:
+            prompt_tokens = provider.count_prompt_tokens(messages, system)
+        backup = next(iter(self.alternates(provider, streaming=True, prompt_tokens=prompt_tokens)), None)
+
+        async def first_item(stream):
+            return stream, await stream.__anext__()
+
+        candidates = [provider]
+        streams = [provider.stream(messages, temperature, system, priority, prompt_tokens)]
+        tasks = [asyncio.create_task(first_item(streams[0]))]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(provider, streaming=True))
+            if backup is not None and (not done or tasks[0].exception() is not None):
+                logger.info(f"Hedging {provider.name} stream to {backup.name}")
+                candidates.append(backup)
+                streams.append(backup.stream(messages, temperature, system, priority, prompt_tokens))
+                tasks.append(asyncio.create_task(first_item(streams[1])))
+
+            error = None
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task.result()
+                        break
+                    error = task.exception()
+            if winner is None:
+                raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let cancelled first reads unwind before closing their streams
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for stream in streams:
+                if winner is None or stream is not winner[0]:
+                    await stream.aclose()
+
+        stream, item = winner
+        yield StreamModel(candidates[streams.index(stream)].model)
+        yield item
+        async for item in stream:
+            yield item
+
+    def route_key(self, name: str, routing: str = "default") -> str:
+        """Model part of cache and coalescing keys; hedged answers may come from any model."""
+        model = self.get(name).model
+        return model if routing == "default" else f"{routing}:{model}"
+
+    async def complete(
+        self,
+        name: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        system: Optional[SystemPrompt] = None,
+        routing: str = "default",
+        priority: int = INTERACTIVE,
+        prompt_tokens: Optional[int] = None,
+    ) -> Completion:
+        """
+        Answer with provider `name`, or with whichever answers first when `routing` is "fast".
+
+        `prompt_tokens` is the prompt's size when the caller already counted it
+        (see `Context.tokens`); otherwise it is counted here.
+        """
+        if routing == "fast":
+            return await self.complete_fast(name, messages, temperature, system, priority, prompt_tokens)
+        return await self.get(name).complete(messages, temperature, system, priority, prompt_tokens)
+
+    def stream(
+        self,
+        name: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        system: Optional[SystemPrompt] = None,
+        routing: str = "default",
+        priority: int = INTERACTIVE,
+        prompt_tokens: Optional[int] = None,
+    ) -> AsyncIterator[StreamItem]:
+        # Resolve and check eagerly so an unconfigured or overloaded provider
+        # fails the request with a proper status, not the stream
+        provider = self.check(name)
+        if routing == "fast":
+            return self.stream_fast(name, messages, temperature, system, priority, prompt_tokens)
+        return provider.stream(messages, temperature, system, priority, prompt_tokens)
+
+    def stats(self) -> Dict[str, dict]:
+        return {
+            name: {
+                "model": provider.model,
+                "latency": provider.latency.snapshot(),
+                "ttft": provider.ttft.snapshot(),
+                "admission": provider.scheduler.stats(),
+            }
+            for name, provider in self.providers.items()
+        }
+
+
+def get_providers(request: Request) -> ProviderRegistry:
+    return request.app.state.providers
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import Request
+
+from app.cache import TieredCache
+from app.providers import Completion
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "llm_service_response_cache")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 60 * 60)))
+RESPONSE_CACHE_MEMORY_BYTES = int(os.getenv("RESPONSE_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_DISK_BYTES = int(os.getenv("RESPONSE_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+# Replies sampled above this temperature are not repeatable, so never cached
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0"))
+
+CACHE_HEADER = "X-Cache"
+
+
+def cache_key(model: str, messages: List[Dict[str, str]], temperature: float, system: str = "") -> str:
+    normalized = [
+        {"role": msg["role"].strip().lower(), "content": str(msg["content"]).strip()}
+        for msg in messages
+    ]
+    payload = json.dumps(
+        {"model": model, "messages": normalized, "temperature": temperature, "system": system.strip()},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(TieredCache):
+    """Completions of repeatable (low temperature) prompts."""
+
+    def __init__(
+        self,
+        directory: str = RESPONSE_CACHE_DIR,
+        memory_bytes: int = RESPONSE_CACHE_MEMORY_BYTES,
+        disk_bytes: int = RESPONSE_CACHE_DISK_BYTES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_temperature: float = RESPONSE_CACHE_MAX_TEMPERATURE,
+    ):
+        super().__init__(directory, memory_bytes, disk_bytes, ttl=ttl)
+        self.max_temperature = max_temperature
+
+    def cacheable(self, temperature: float) -> bool:
+        return temperature <= self.max_temperature
+
+
+def get_response_cache(request: Request) -> Optional[ResponseCache]:
+    return request.app.state.response_cache
+
+
+async def cached_completion(
+    cache: Optional[ResponseCache],
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    generate: Callable[[], Awaitable[Completion]],
+    system: str = "",
+) -> Tuple[Completion, str]:
+    """
+    Return the completion and its X-Cache status (HIT, MISS or BYPASS).
+
+    `generate` makes the upstream call and is only awaited on a miss.
+    """
+    if cache is None or not cache.cacheable(temperature):
+        return await generate(), "BYPASS"
+
+    key = cache_key(model, messages, temperature, system)
+    cached = await cache.get(key)
+    if cached is not None:
+        return Completion(cached["text"], cached.get("model", model), cached.get("usage", {})), "HIT"
+
+    completion = await generate()
+    await cache.put(key, {"text": completion.text, "model": completion.model, "usage": completion.usage})
+    return completion, "MISS"
@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import math
+import os
+import re
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi import Request, UploadFile
+
+from app.cache import TieredCache
+from app.context import input_budget
+from app.extraction import DocumentExtractor, ExtractedDocument, extract_upload
+from app.history import conversations
+from app.metrics import timed_stage
+from app.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Chunks are cut by words; 200 words is roughly 260 tokens
+RETRIEVAL_CHUNK_WORDS = int(os.getenv("RETRIEVAL_CHUNK_WORDS", "200"))
+# Words shared by neighbouring chunks, so a passage cut in two is still found whole
+RETRIEVAL_CHUNK_OVERLAP_WORDS = int(os.getenv("RETRIEVAL_CHUNK_OVERLAP_WORDS", "40"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+# Upper bound on excerpt tokens per turn; never more than half the model's input budget
+RETRIEVAL_MAX_TOKENS = int(os.getenv("RETRIEVAL_MAX_TOKENS", "4000"))
+
+DOC_INDEX_DIR = os.getenv("DOC_INDEX_DIR") or os.path.join(tempfile.gettempdir(), "llm_service_doc_index")
+DOC_INDEX_MEMORY_BYTES = int(os.getenv("DOC_INDEX_MEMORY_BYTES", str(128 * 1024 * 1024)))
+DOC_INDEX_DISK_BYTES = int(os.getenv("DOC_INDEX_DISK_BYTES", str(1024 * 1024 * 1024)))
+
+# BM25 parameters, the usual defaults
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# A built index takes a few times the memory of its text (postings, lengths)
+INDEX_SIZE_FACTOR = 3
+
+EXCERPTS_HEADER = "Relevant excerpts from the attached files:"
+DOCUMENTS_HEADER = "Files attached to this conversation:"
+
+_TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from had has have he her his how i if in into is it its "
+    "me my no not of on or our she so that the their them then there these they this to was we were what "
+    "when where which who why will with you your".split()
+)
+
+
+def terms(text: str) -> List[str]:
+    return [term for term in _TERM_PATTERN.findall(text.lower()) if term not in STOPWORDS]
+
+
+def chunk_text(
+    text: str,
+    words_per_chunk: int = RETRIEVAL_CHUNK_WORDS,
+    overlap: int = RETRIEVAL_CHUNK_OVERLAP_WORDS,
+) -> List[str]:
+    words = text.split()
+    if not words:
+        return []
+    step = max(1, words_per_chunk - overlap)
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + words_per_chunk]))
+        if start + words_per_chunk >= len(words):
+            break
+    return chunks
+
+
+class DocumentIndex:
+    """
+    BM25 index over the chunks of one document.
+
+    Built once per document; a search only touches the postings of the
+    query's terms, so its cost does not grow with the document.
+    """
+
+    def __init__(self, digest: str, filename: str, text: str, chunks: Sequence[str]):
+        self.digest = digest
+        self.filename = filename
+        self.text = text
+        self.chunks = list(chunks)
+        self.tokens = [count_tokens(chunk) for chunk in self.chunks]
+        self.text_tokens = count_tokens(text)
+        # term -> [(chunk, term frequency)]
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.lengths: List[int] = []
+        for i, chunk in enumerate(self.chunks):
+            counts = Counter(terms(chunk))
+            self.lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self.postings.setdefault(term, []).append((i, tf))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+    @classmethod
+    def build(cls, document: ExtractedDocument) -> "DocumentIndex":
+        return cls(document.digest, document.filename, document.text, chunk_text(document.text))
+
+    @property
+    def size(self) -> int:
+        return len(self.text) * INDEX_SIZE_FACTOR
+
+    def search(self, query: str, limit: int) -> List[Tuple[float, int]]:
+        """Up to `limit` (score, chunk) pairs with a positive score, best first."""
+        count = len(self.chunks)
+        scores: Dict[int, float] = {}
+        for term in set(terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[chunk] / self.average_length)
+                scores[chunk] = scores.get(chunk, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(((score, chunk) for chunk, score in scores.items()), reverse=True)
+        return ranked[:limit]
+
+    def spread(self, limit: int) -> List[int]:
+        """`limit` chunks evenly spaced through the document, for queries that match nothing."""
+        count = len(self.chunks)
+        if count <= limit:
+            return list(range(count))
+        return [round(i * (count - 1) / (limit - 1)) if limit > 1 else 0 for i in range(limit)]
+
+
+class DocumentIndexCache(TieredCache):
+    """
+    Document chunks keyed by the SHA-256 of the uploaded bytes.
+
+    The chunks are kept on local disk, where every worker on the host can
+    read them; the memory tier holds the built index, so each worker
+    indexes a document at most once while it stays in memory.
+    """
+
+    def __init__(
+        self,
+        directory: str = DOC_INDEX_DIR,
+        memory_bytes: int = DOC_INDEX_MEMORY_BYTES,
+        disk_bytes: int = DOC_INDEX_DISK_BYTES,
+    ):
+        super().__init__(directory, memory_bytes, disk_bytes)
+
+    async def index(self, digest: str) -> Optional[DocumentIndex]:
+        value = await self.get(digest)
+        if value is None or isinstance(value, DocumentIndex):
+            return value
+        index = await asyncio.to_thread(DocumentIndex, digest, value["filename"], value["text"], value["chunks"])
+        self._remember(digest, None, index.size, index)
+        return index
+
+    async def add(self, document: ExtractedDocument) -> DocumentIndex:
+        index = await self.index(document.digest)
+        if index is not None:
+            return index
+        index = await asyncio.to_thread(DocumentIndex.build, document)
+        await self.put(document.digest, {"filename": index.filename, "text": index.text, "chunks": index.chunks})
+        self._remember(document.digest, None, index.size, index)
+        return index
+
+
+def select_excerpts(indexes: Sequence[DocumentIndex], query: str, max_tokens: int, top_k: int) -> str:
+    """The chunks best matching `query`, up to `top_k` and `max_tokens`, in document order."""
+    candidates = [
+        (score, i, chunk)
+        for i, index in enumerate(indexes)
+        for score, chunk in index.search(query, top_k)
+    ]
+    candidates.sort(reverse=True)
+    if not candidates:
+        # Nothing in the query to match on ("summarize this"); sample the documents instead
+        per_document = max(1, top_k // len(indexes))
+        candidates = [(0.0, i, chunk) for i, index in enumerate(indexes) for chunk in index.spread(per_document)]
+
+    selected = []
+    total = 0
+    for _, i, chunk in candidates:
+        if len(selected) == top_k:
+            break
+        tokens = indexes[i].tokens[chunk]
+        if total + tokens > max_tokens:
+            continue
+        selected.append((i, chunk))
+        total += tokens
+    selected.sort()
+    return "\n\n".join(
+        f"[{indexes[i].filename}, part {chunk + 1} of {len(indexes[i].chunks)}]\n{indexes[i].chunks[chunk]}"
+        for i, chunk in selected
+    )
+
+
+@dataclass
+class Turn:
+    """The user's message for one turn: as sent upstream, and as kept in history."""
+
+    content: str
+    stored: str
+    document: Optional[ExtractedDocument] = None
+    # Digests of documents to attach to the conversation once the turn succeeds
+    attachments: List[str] = field(default_factory=list)
+    # Whole documents, when they fit the budget. The same every turn until
+    # another file is attached, so it belongs with the system prompt, where
+    # it stays part of a cacheable prefix
+    reference: str = ""
+
+
+class DocumentLibrary:
+    """
+    Documents uploaded to each conversation, and the excerpts to send per turn.
+
+    An upload is extracted and indexed once; history keeps only a note that
+    the file was attached. Every later turn in the conversation gets the
+    chunks most relevant to its prompt, so prompt size stays bounded
+    however large the documents are.
+    """
+
+    def __init__(
+        self,
+        extractor: DocumentExtractor,
+        cache: Optional[DocumentIndexCache] = None,
+        top_k: int = RETRIEVAL_TOP_K,
+        max_tokens: int = RETRIEVAL_MAX_TOKENS,
+    ):
+        self.extractor = extractor
+        self.cache = cache or DocumentIndexCache()
+        self.top_k = top_k
+        self.max_tokens = max_tokens
+
+    async def turn(self, prompt: str, key: Optional[str], model: str, file: Optional[UploadFile] = None) -> Turn:
+        """
+        Build this turn's user message for conversation `key` (None when the
+        request has no server-side history), with `file` if one was uploaded.
+        """
+        document = await extract_upload(file, self.extractor)
+        digests = await conversations.documents(key) if key else []
+        if document is None and not digests:
+            return Turn(prompt, prompt)
+
+        started = time.perf_counter()
+        with timed_stage("retrieve"):
+            indexes = []
+            for digest in digests:
+                index = await self.cache.index(digest)
+                if index is None:
+                    logger.warning(f"Index for document {digest} is gone, leaving it out of {key}")
+                    continue
+                indexes.append(index)
+            if document is not None and document.digest not in digests:
+                indexes.append(await self.cache.add(document))
+            max_tokens = min(self.max_tokens, input_budget(model) // 2)
+            reference = ""
+            content = prompt
+            if sum(index.text_tokens for index in indexes) <= max_tokens:
+                reference = f"{DOCUMENTS_HEADER}\n\n" + "\n\n".join(
+                    f"[{index.filename}]\n{index.text}" for index in indexes
+                )
+            else:
+                excerpts = select_excerpts(indexes, prompt, max_tokens, self.top_k)
+                if excerpts:
+                    content = f"{prompt}\n\n{EXCERPTS_HEADER}\n\n{excerpts}"
+        logger.info(f"Selected document text from {len(indexes)} document(s) in {time.perf_counter() - started:.3f}s")
+
+        if document is None:
+            return Turn(content, prompt, reference=reference)
+        stored = f"{prompt}\n\n[Attached file: {document.filename}]"
+        return Turn(content, stored, document, [document.digest] if key else [], reference)
+
+
+def get_documents(request: Request) -> DocumentLibrary:
+    return request.app.state.documents
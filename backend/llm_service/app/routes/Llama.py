@@ -1,9 +1,15 @@
-import os
-from groq import Groq
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, Request, Response
 from datetime import datetime
 from pydantic import BaseModel
+from typing import Optional, Tuple
+from app.history import conversations, conversation_key
+from app.context import build_context, with_summary
+from app.streaming import sse_response
+from app.response_cache import CACHE_HEADER, ResponseCache, cache_key, cached_completion, get_response_cache
+from app.coalesce import COALESCED_HEADER, Coalescer, get_coalescer
+from app.cancellation import request_deadline, until_cancelled, with_deadline
+from app.providers import ProviderRegistry, Routing, get_providers, upstream_error
 
 llamaRouter = APIRouter(prefix="/llama", tags=["llama"])
 
@@ -12,51 +18,96 @@ SYSTEM_MESSAGE = "Make sure you are kind, welcoming, accurate and precise in res
 class GenerateRequest(BaseModel):
     prompt: str
     temperature: float = 0.7
+    conversation_id: Optional[str] = None
+    routing: Routing = "default"
 
 load_dotenv()
-llama = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
-llama_history = [
-    {
-        "role": "system",
-        "content": SYSTEM_MESSAGE
-    }
-]
+async def build_messages(key: Optional[str], user_msg: dict, model: str) -> Tuple[str, list, int]:
+    """Return the system prompt, the messages to send for this turn and their token count."""
+    context = await build_context(key, user_msg, model, SYSTEM_MESSAGE)
+    return with_summary(SYSTEM_MESSAGE, context.summary), context.messages, context.tokens
+
+async def save_history(key: Optional[str], user_msg: dict, assistant_msg: str):
+    # Requests without a conversation id are stateless
+    if key:
+        await conversations.append(key, user_msg, {
+            "role": "assistant",
+            "content": assistant_msg
+        })
 
 @llamaRouter.post("/generate")
-async def llamaTime(data: GenerateRequest):
-    global llama_history
+async def llamaTime(
+    data: GenerateRequest,
+    request: Request,
+    response: Response,
+    providers: ProviderRegistry = Depends(get_providers),
+    cache: Optional[ResponseCache] = Depends(get_response_cache),
+    coalescer: Coalescer = Depends(get_coalescer)
+):
+    key = conversation_key("llama", data.conversation_id)
     try:
-        # Add user message to history
-        llama_history.append({
+        user_msg = {
             "role": "user",
             "content": data.prompt
-        })
+        }
     
+        system, messages, prompt_tokens = await build_messages(key, user_msg, providers.get("llama").model)
+        model_key = providers.route_key("llama", data.routing)
+
         # Get response from API
-        response = llama.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=llama_history,
-            temperature=data.temperature
-        )
+        def generate():
+            return providers.complete(
+                "llama", messages, data.temperature, system, routing=data.routing, prompt_tokens=prompt_tokens
+            )
     
-        # Extract assistant's response
-        assistant_msg = response.choices[0].message.content
+        # Repeatable (low temperature) prompts may be answered from the cache,
+        # identical requests already in flight share one upstream call, and the
+        # call is given up if this client disconnects or its deadline passes
+        (completion, cache_status), shared = await until_cancelled(request, coalescer.run(
+            cache_key(model_key, messages, data.temperature, system),
+            lambda: cached_completion(cache, model_key, messages, data.temperature, generate, system)
+        ))
+        response.headers[CACHE_HEADER] = cache_status
+        response.headers[COALESCED_HEADER] = str(shared).lower()
     
-        # Add assistant's response to history
-        llama_history.append({
-            "role": "assistant",
-            "content": assistant_msg
-        })
+        # Add the exchange to this conversation's history
+        await save_history(key, user_msg, completion.text)
     
         return {
-            "text": assistant_msg,
-            "model": "llama-3.3-70b-versatile",
+            "text": completion.text,
+            "model": completion.model,
             "timestamp": datetime.now().isoformat()
         }
     except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Internal Server Error: {str(e)}"
-        ) 
-   
\ No newline at end of file
+        raise upstream_error(e, "Internal Server Error")
+
+@llamaRouter.post("/generate-stream")
+async def llamaTimeStream(
+    data: GenerateRequest,
+    request: Request,
+    providers: ProviderRegistry = Depends(get_providers),
+    coalescer: Coalescer = Depends(get_coalescer)
+):
+    key = conversation_key("llama", data.conversation_id)
+    user_msg = {
+        "role": "user",
+        "content": data.prompt
+    }
+
+    system, messages, prompt_tokens = await build_messages(key, user_msg, providers.get("llama").model)
+    model_key = providers.route_key("llama", data.routing)
+    # Shed load before the response starts rather than as a stream error
+    providers.check("llama")
+    tokens = with_deadline(coalescer.stream(
+        cache_key(model_key, messages, data.temperature, system),
+        lambda: providers.stream(
+            "llama", messages, data.temperature, system, routing=data.routing, prompt_tokens=prompt_tokens
+        )
+    ), request_deadline(request))
+    # History is only updated once the whole reply has been streamed
+    return sse_response(
+        tokens,
+        providers.get("llama").model,
+        on_complete=lambda text: save_history(key, user_msg, text)
+    )
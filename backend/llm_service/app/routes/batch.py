@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import List, Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from app.admission import BATCH
+from app.providers import ProviderRegistry, Routing, get_providers, upstream_error
+
+logger = logging.getLogger(__name__)
+
+batchRouter = APIRouter(prefix="/batch", tags=["batch"])
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+
+# Upstream calls in flight per provider, shared by every running batch
+BATCH_CONCURRENCY = {
+    "gpt": int(os.getenv("BATCH_CONCURRENCY_GPT", "32")),
+    "claude": int(os.getenv("BATCH_CONCURRENCY_CLAUDE", "32")),
+    "llama": int(os.getenv("BATCH_CONCURRENCY_LLAMA", "32")),
+}
+
+
+def batch_semaphores() -> dict:
+    return {provider: asyncio.Semaphore(limit) for provider, limit in BATCH_CONCURRENCY.items()}
+
+
+def get_batch_semaphores(request: Request) -> dict:
+    return request.app.state.batch_semaphores
+
+
+class BatchItem(BaseModel):
+    provider: Literal["gpt", "claude", "llama"]
+    prompt: str
+    temperature: float = 0.7
+    system: Optional[str] = None
+    id: Optional[str] = None
+    routing: Routing = "default"
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+
+
+async def run_item(
+    providers: ProviderRegistry,
+    semaphores: dict,
+    index: int,
+    item: BatchItem
+) -> dict:
+    result = {"index": index, "id": item.id, "provider": item.provider}
+    started = time.perf_counter()
+    try:
+        async with semaphores[item.provider]:
+            completion = await providers.complete(
+                item.provider,
+                [{"role": "user", "content": item.prompt}],
+                item.temperature,
+                item.system,
+                routing=item.routing,
+                # Interactive traffic is admitted ahead of batch items
+                priority=BATCH
+            )
+        result.update(text=completion.text, model=completion.model, usage=completion.usage)
+    except HTTPException as e:
+        result.update(error=e.detail, status=e.status_code)
+    except Exception as e:
+        logger.error(f"Batch item {index} ({item.provider}) failed: {str(e)}")
+        error = upstream_error(e)
+        result.update(error=error.detail, status=error.status_code)
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+@batchRouter.post("/generate")
+async def generate_batch(
+    data: BatchRequest,
+    providers: ProviderRegistry = Depends(get_providers),
+    semaphores: dict = Depends(get_batch_semaphores),
+):
+    """
+    Run every item concurrently and stream results back as NDJSON, one line
+    per item in completion order. Failed items carry an `error` field instead
+    of `text`; they do not fail the batch.
+    """
+    if len(data.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch has {len(data.items)} items, the limit is {BATCH_MAX_ITEMS}"
+        )
+
+    async def results():
+        tasks = [asyncio.create_task(run_item(providers, semaphores, i, item)) for i, item in enumerate(data.items)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            # Client went away mid-batch: stop paying for the rest
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
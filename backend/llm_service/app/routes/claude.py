@@ -1,13 +1,19 @@
-import os
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends, Request
 from datetime import datetime
-from anthropic import Anthropic
 from pydantic import BaseModel
 from typing import Optional
-import PyPDF2
-import io
+import logging
+from app.history import conversations, conversation_key
+from app.context import build_context, system_sections
+from app.streaming import sse_response
+from app.extraction import server_timing
+from app.retrieval import DocumentLibrary, Turn, get_documents
+from app.cancellation import request_deadline, until_cancelled, with_deadline
+from app.metrics import JSONResponse
+from app.providers import ProviderRegistry, Routing, get_providers, upstream_error
+
+logger = logging.getLogger(__name__)
 
 claudeRouter = APIRouter(prefix='/claude', tags=["claude"])
 
@@ -16,124 +22,163 @@ SYSTEM_MESSAGE = "Make sure you are kind, welcoming, accurate and precise in res
 class GenerateRequest(BaseModel):
     prompt: str
     temperature: float = 0.7
+    conversation_id: Optional[str] = None
+    routing: Routing = "default"
 
 load_dotenv()
-claude = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-
-claude_history = []
-
-async def extract_file_content(file: UploadFile) -> str:
-    content = await file.read()
-    if file.content_type == "application/pdf":
-        # Handle PDF files
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-        text_content = ""
-        for page in pdf_reader.pages:
-            text_content += page.extract_text() + "\n"
-        return text_content
-    elif file.content_type.startswith("text/"):
-        # Handle text files
-        return content.decode('utf-8')
-    else:
-        # For other file types, return file info
-        return f"[File: {file.filename} (type: {file.content_type})]"
+
+async def save_history(key: Optional[str], turn: Turn, assistant_msg: str):
+    # Requests without a conversation id are stateless
+    if key:
+        await conversations.append(key, {"role": "user", "content": turn.stored}, {
+            "role": "assistant",
+            "content": assistant_msg
+        }, documents=turn.attachments)
 
 @claudeRouter.post("/generate", response_class=JSONResponse)
 async def claudeTime(
+    request: Request,
     prompt: str = Form(...),
     temperature: float = Form(0.7),
-    file: UploadFile = File(None)
+    file: UploadFile = File(None),
+    conversation_id: Optional[str] = Form(None),
+    routing: Routing = Form("default"),
+    providers: ProviderRegistry = Depends(get_providers),
+    documents: DocumentLibrary = Depends(get_documents)
 ):
-    global claude_history
+    key = conversation_key("claude", conversation_id)
     try:
-        # If file is provided, append its content to the prompt
-        if file:
-            try:
-                file_text = await extract_file_content(file)
-                full_prompt = f"{prompt}\n\nHere's the file content:\n\n{file_text}"
-            except Exception as file_error:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Error processing file: {str(file_error)}"
-                )
-        else:
-            full_prompt = prompt
-
-        claude_history.append({
-            "role": "user",
-            "content": full_prompt
-        })
+        model = providers.get("claude").model
+        # The file is indexed with the conversation; only relevant excerpts are sent
+        turn = await documents.turn(prompt, key, model, file)
 
-        # Convert history to messages format
-        messages = []
-        for msg in claude_history:
-            messages.append({"role": msg["role"], "content": msg["content"]})
-
-        response = claude.messages.create(
-            model="claude-sonnet-4-20250514",
-            system=SYSTEM_MESSAGE,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=1024
-        )
-
-        ass_msg = response.content[0].text
-        claude_history.append({
-            "role": "assistant",
-            "content": ass_msg
-        })
+        user_msg = {
+            "role": "user",
+            "content": turn.content
+        }
+        system = [SYSTEM_MESSAGE, turn.reference]
+        context = await build_context(key, user_msg, model, system)
+
+        completion = await until_cancelled(request, providers.complete(
+            "claude",
+            context.messages,
+            temperature,
+            system_sections(system, context.summary),
+            routing=routing,
+            prompt_tokens=context.tokens
+        ))
+
+        await save_history(key, turn, completion.text)
 
         return JSONResponse(content={
-            "text": ass_msg,
-            "model": "claude-sonnet-4-20250514",
+            "text": completion.text,
+            "model": completion.model,
             "timestamp": datetime.now().isoformat()
-        })
+        }, headers=server_timing(turn.document))
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error details: {str(e)}")  # Add detailed logging
-        raise HTTPException(
-            status_code=500,
-            detail=f"Internal Server Error: {str(e)}"
-        )
+        logger.error(f"Error generating response: {str(e)}")
+        raise upstream_error(e, "Internal Server Error")
 
 # JSON endpoint for regular text messages (no file upload)
 @claudeRouter.post("/generate-json", response_class=JSONResponse)
-async def claudeTimeJson(data: GenerateRequest):
-    global claude_history
+async def claudeTimeJson(
+    data: GenerateRequest,
+    request: Request,
+    providers: ProviderRegistry = Depends(get_providers),
+    documents: DocumentLibrary = Depends(get_documents)
+):
+    key = conversation_key("claude", data.conversation_id)
     try:
-        claude_history.append({
+        model = providers.get("claude").model
+        turn = await documents.turn(data.prompt, key, model)
+        user_msg = {
             "role": "user",
-            "content": data.prompt
-        })
-
-        # Convert history to messages format
-        messages = []
-        for msg in claude_history:
-            messages.append({"role": msg["role"], "content": msg["content"]})
-
-        response = claude.messages.create(
-            model="claude-sonnet-4-20250514",
-            system=SYSTEM_MESSAGE,
-            messages=messages,
-            temperature=data.temperature,
-            max_tokens=1024
-        )
-
-        ass_msg = response.content[0].text
-        claude_history.append({
-            "role": "assistant",
-            "content": ass_msg
-        })
+            "content": turn.content
+        }
+        system = [SYSTEM_MESSAGE, turn.reference]
+        context = await build_context(key, user_msg, model, system)
+
+        completion = await until_cancelled(request, providers.complete(
+            "claude",
+            context.messages,
+            data.temperature,
+            system_sections(system, context.summary),
+            routing=data.routing,
+            prompt_tokens=context.tokens
+        ))
+
+        await save_history(key, turn, completion.text)
 
         return JSONResponse(content={
-            "text": ass_msg,
-            "model": "claude-sonnet-4-20250514",
+            "text": completion.text,
+            "model": completion.model,
             "timestamp": datetime.now().isoformat()
         })
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error details: {str(e)}")  # Add detailed logging
-        raise HTTPException(
-            status_code=500,
-            detail=f"Internal Server Error: {str(e)}"
-        )
\ No newline at end of file
+        logger.error(f"Error generating response: {str(e)}")
+        raise upstream_error(e, "Internal Server Error")
+
+async def claude_stream(
+    request: Request,
+    key: Optional[str],
+    turn: Turn,
+    temperature: float,
+    providers: ProviderRegistry,
+    routing: str = "default"
+):
+    user_msg = {
+        "role": "user",
+        "content": turn.content
+    }
+
+    system = [SYSTEM_MESSAGE, turn.reference]
+    context = await build_context(key, user_msg, providers.get("claude").model, system)
+
+    tokens = with_deadline(providers.stream(
+        "claude",
+        context.messages,
+        temperature,
+        system_sections(system, context.summary),
+        routing=routing,
+        prompt_tokens=context.tokens
+    ), request_deadline(request))
+    # History is only updated once the whole reply has been streamed
+    return sse_response(
+        tokens,
+        providers.get("claude").model,
+        on_complete=lambda text: save_history(key, turn, text)
+    )
+
+@claudeRouter.post("/generate-stream")
+async def claudeTimeStream(
+    request: Request,
+    prompt: str = Form(...),
+    temperature: float = Form(0.7),
+    file: UploadFile = File(None),
+    conversation_id: Optional[str] = Form(None),
+    routing: Routing = Form("default"),
+    providers: ProviderRegistry = Depends(get_providers),
+    documents: DocumentLibrary = Depends(get_documents)
+):
+    key = conversation_key("claude", conversation_id)
+    turn = await documents.turn(prompt, key, providers.get("claude").model, file)
+    response = await claude_stream(request, key, turn, temperature, providers, routing)
+    response.headers.update(server_timing(turn.document))
+    return response
+
+@claudeRouter.post("/generate-json-stream")
+async def claudeTimeJsonStream(
+    data: GenerateRequest,
+    request: Request,
+    providers: ProviderRegistry = Depends(get_providers),
+    documents: DocumentLibrary = Depends(get_documents)
+):
+    key = conversation_key("claude", data.conversation_id)
+    turn = await documents.turn(data.prompt, key, providers.get("claude").model)
+    return await claude_stream(request, key, turn, data.temperature, providers, data.routing)
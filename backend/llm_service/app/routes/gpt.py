@@ -1,17 +1,25 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
-from fastapi.responses import JSONResponse
-from openai import OpenAI
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends, Request
+from openai import AsyncOpenAI
 from pydantic import BaseModel
-import os
 from dotenv import load_dotenv
 from datetime import datetime
-import PyPDF2
-import io
-from typing import Optional, List, Dict, Any
-import base64
+from typing import Optional, List, Dict, Any, Sequence, Tuple
+import asyncio
 import logging
-import requests
 from fastapi.staticfiles import StaticFiles
+from app.clients import get_openai
+from app.history import conversations, conversation_key
+from app.context import build_context, trim_messages, with_summary
+from app.streaming import sse_response
+from app.extraction import server_timing
+from app.retrieval import DocumentLibrary, Turn, get_documents
+from app.response_cache import CACHE_HEADER, ResponseCache, cache_key, cached_completion, get_response_cache
+from app.coalesce import COALESCED_HEADER, Coalescer, get_coalescer
+from app.blobs import BlobStore, blob_url, get_blob_store
+from app.admission import IMAGE
+from app.cancellation import request_deadline, until_cancelled, with_deadline
+from app.metrics import JSONResponse, timed_stage
+from app.providers import ProviderRegistry, Routing, get_providers, upstream_error
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,7 +33,11 @@ router = APIRouter(prefix="/gpt", tags=["gpt"])
 class GenerateRequest(BaseModel):
     prompt: str
     temperature: float = 0.7
+    # Older clients send the whole transcript; newer ones send a conversation
+    # id and only the new prompt, and the history is kept server-side
     conversation_history: Optional[List[Dict[str, Any]]] = []
+    conversation_id: Optional[str] = None
+    routing: Routing = "default"
 
 class ImageGenerateRequest(BaseModel):
     prompt: str
@@ -34,24 +46,55 @@ class ImageGenerateRequest(BaseModel):
     style: str = "natural"
     n: int = 1
 
-async def extract_file_content(file: UploadFile) -> str:
-    content = await file.read()
-    if file.content_type == "application/pdf":
-        # Handle PDF files
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-        text_content = ""
-        for page in pdf_reader.pages:
-            text_content += page.extract_text() + "\n"
-        return text_content
-    elif file.content_type.startswith("text/"):
-        # Handle text files
-        return content.decode('utf-8')
-    else:
-        # For other file types, return file info
-        return f"[File: {file.filename} (type: {file.content_type})]"
+async def build_messages(
+    prompt: str,
+    conversation_id: Optional[str],
+    model: str,
+    conversation_history: Optional[list] = None,
+    reference: str = ""
+) -> Tuple[str, list, int]:
+    """Return the system prompt, the messages to send for this turn and their token count."""
+    user_msg = {
+        "role": "user",
+        "content": prompt
+    }
+    if not conversation_id:
+        # Client-supplied history may carry its own system messages
+        context = trim_messages(list(conversation_history or []) + [user_msg], model, reference)
+        return reference, context.messages, context.tokens
+
+    context = await build_context(conversation_key("gpt", conversation_id), user_msg, model, reference)
+    return with_summary(reference, context.summary), context.messages, context.tokens
+
+async def save_history(conversation_id: Optional[str], prompt: str, assistant_msg: str, documents: Sequence[str] = ()):
+    if conversation_id:
+        await conversations.append(
+            conversation_key("gpt", conversation_id),
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": assistant_msg},
+            documents=documents
+        )
+
+async def prepare_turn(
+    documents: DocumentLibrary,
+    prompt: str,
+    conversation_id: Optional[str],
+    model: str,
+    file: Optional[UploadFile] = None
+) -> Turn:
+    key = conversation_key("gpt", conversation_id)
+    return await documents.turn(prompt, key, model, file)
 
 @router.post("/generate", response_class=JSONResponse)
-async def generate_text(data: GenerateRequest):
+async def generate_text(
+    data: GenerateRequest,
+    request: Request,
+    client: AsyncOpenAI = Depends(get_openai),
+    providers: ProviderRegistry = Depends(get_providers),
+    cache: Optional[ResponseCache] = Depends(get_response_cache),
+    coalescer: Coalescer = Depends(get_coalescer),
+    documents: DocumentLibrary = Depends(get_documents)
+):
     try:
         # Check if the prompt starts with /image
         if data.prompt.startswith("/image"):
@@ -64,75 +107,102 @@ async def generate_text(data: GenerateRequest):
                 )
             
             # Call the image generation function
-            return await generate_image(ImageGenerateRequest(prompt=image_prompt))
-            
-        # If not an image command, proceed with normal text generation
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise HTTPException(
-                status_code=500, 
-                detail="OPENAI_API_KEY not found in environment variables"
+            return await generate_image(
+                ImageGenerateRequest(prompt=image_prompt), request, client, providers, get_blob_store(request)
             )
             
-        client = OpenAI(api_key=api_key)
-        
         # Build messages array from conversation history + current prompt
-        messages = []
-        
-        # Add conversation history if provided
-        if data.conversation_history:
-            messages.extend(data.conversation_history)
-        
-        # Add current user message
-        messages.append({
-            "role": "user",
-            "content": data.prompt
-        })
-        
-        # Call OpenAI API with full conversation history
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            temperature=data.temperature
+        model = providers.get("gpt").model
+        turn = await prepare_turn(documents, data.prompt, data.conversation_id, model)
+        system, messages, prompt_tokens = await build_messages(
+            turn.content, data.conversation_id, model, data.conversation_history, turn.reference
         )
-        
-        # Extract assistant's response
-        assistant_msg = response.choices[0].message.content
+        model_key = providers.route_key("gpt", data.routing)
+
+        # Call OpenAI API with full conversation history
+        def generate():
+            return providers.complete(
+                "gpt", messages, data.temperature, system, routing=data.routing, prompt_tokens=prompt_tokens
+            )
+
+        # Repeatable (low temperature) prompts may be answered from the cache,
+        # identical requests already in flight share one upstream call, and the
+        # call is given up if this client disconnects or its deadline passes
+        (completion, cache_status), shared = await until_cancelled(request, coalescer.run(
+            cache_key(model_key, messages, data.temperature, system),
+            lambda: cached_completion(cache, model_key, messages, data.temperature, generate, system)
+        ))
+        await save_history(data.conversation_id, turn.stored, completion.text)
         
         return JSONResponse(content={
-            "text": assistant_msg,
-            "model": "gpt-4",
+            "text": completion.text,
+            "model": completion.model,
             "timestamp": datetime.now().isoformat()
-        })
+        }, headers={CACHE_HEADER: cache_status, COALESCED_HEADER: str(shared).lower()})
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error generating response: {str(e)}"
+        raise upstream_error(e)
+
+@router.post("/generate-stream")
+async def generate_text_stream(
+    data: GenerateRequest,
+    request: Request,
+    client: AsyncOpenAI = Depends(get_openai),
+    providers: ProviderRegistry = Depends(get_providers),
+    coalescer: Coalescer = Depends(get_coalescer),
+    documents: DocumentLibrary = Depends(get_documents)
+):
+    # Image commands have nothing to stream, answer them like /generate
+    if data.prompt.startswith("/image"):
+        return await generate_text(data, request, client, providers, None, coalescer, documents)
+
+    model = providers.get("gpt").model
+    turn = await prepare_turn(documents, data.prompt, data.conversation_id, model)
+    system, messages, prompt_tokens = await build_messages(
+        turn.content, data.conversation_id, model, data.conversation_history, turn.reference
+    )
+    model_key = providers.route_key("gpt", data.routing)
+    # Shed load before the response starts rather than as a stream error
+    providers.check("gpt")
+
+    tokens = with_deadline(coalescer.stream(
+        cache_key(model_key, messages, data.temperature, system),
+        lambda: providers.stream(
+            "gpt", messages, data.temperature, system, routing=data.routing, prompt_tokens=prompt_tokens
         )
+    ), request_deadline(request))
+    return sse_response(
+        tokens,
+        providers.get("gpt").model,
+        on_complete=lambda text: save_history(data.conversation_id, turn.stored, text)
+    )
 
 @router.post("/image", response_class=JSONResponse)
-async def generate_image(data: ImageGenerateRequest):
+async def generate_image(
+    data: ImageGenerateRequest,
+    request: Request,
+    client: AsyncOpenAI = Depends(get_openai),
+    providers: ProviderRegistry = Depends(get_providers),
+    blobs: BlobStore = Depends(get_blob_store)
+):
     try:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            logger.error("OPENAI_API_KEY not found in environment variables")
-            raise HTTPException(
-                status_code=500, 
-                detail="OPENAI_API_KEY not found in environment variables"
-            )
-            
         logger.info(f"Generating image with prompt: {data.prompt}")
-        client = OpenAI(api_key=api_key)
         
-        # Call OpenAI API for image generation
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=data.prompt,
-            size=data.size,
-            quality=data.quality,
-            style=data.style,
-            n=data.n
-        )
+        # Call OpenAI API for image generation, queued behind chat traffic
+        async def create_images():
+            async with providers.get("gpt").scheduler.slot(priority=IMAGE):
+                with timed_stage("upstream"):
+                    return await client.images.generate(
+                        model="dall-e-3",
+                        prompt=data.prompt,
+                        size=data.size,
+                        quality=data.quality,
+                        style=data.style,
+                        n=data.n
+                    )
+
+        response = await until_cancelled(request, create_images())
         
         if not response.data or len(response.data) == 0:
             logger.error("No image data received from OpenAI")
@@ -141,79 +211,61 @@ async def generate_image(data: ImageGenerateRequest):
                 detail="No image data received from OpenAI"
             )
         
-        # Get the image URL from the response
-        image_url = response.data[0].url
-        
-        # Download the image and convert to base64
-        try:
-            image_response = requests.get(image_url)
-            image_response.raise_for_status()
-            image_data = image_response.content
-            base64_image = base64.b64encode(image_data).decode('utf-8')
-            
-            logger.info("Successfully generated and encoded image")
-            
-            return JSONResponse(content={
-                "image": f"data:image/png;base64,{base64_image}",
-                "model": "dall-e-3",
-                "timestamp": datetime.now().isoformat()
-            })
-        except Exception as e:
-            logger.error(f"Error processing image: {str(e)}")
-            # Fallback to returning the URL if base64 conversion fails
-            return JSONResponse(content={
-                "image_url": image_url,
-                "model": "dall-e-3",
-                "timestamp": datetime.now().isoformat()
-            })
+        # Download every image into the blob store in parallel and hand out
+        # our own URLs, since OpenAI's expire after an hour
+        image_urls = [image.url for image in response.data]
+        with timed_stage("upstream"):
+            names = await asyncio.gather(
+                *(blobs.fetch(url) for url in image_urls),
+                return_exceptions=True
+            )
+        for i, name in enumerate(names):
+            if isinstance(name, Exception):
+                logger.error(f"Error storing image: {str(name)}")
+                # Fall back to OpenAI's URL for this image
+                continue
+            image_urls[i] = blob_url(request, name)
+
+        logger.info(f"Successfully generated and stored {len(image_urls)} image(s)")
+
+        return JSONResponse(content={
+            "image_url": image_urls[0],
+            "image_urls": image_urls,
+            "model": "dall-e-3",
+            "timestamp": datetime.now().isoformat()
+        })
             
     except Exception as e:
         logger.error(f"Error generating image: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error generating image: {str(e)}"
-        )
+        raise upstream_error(e, "Error generating image")
 
 @router.post("/generate-form", response_class=JSONResponse)
 async def generate_text_form(
+    request: Request,
     prompt: str = Form(...),
     temperature: float = Form(0.7),
-    file: UploadFile = File(None)
+    file: UploadFile = File(None),
+    conversation_id: Optional[str] = Form(None),
+    routing: Routing = Form("default"),
+    providers: ProviderRegistry = Depends(get_providers),
+    documents: DocumentLibrary = Depends(get_documents)
 ):
     try:
-        # If file is provided, append its content to the prompt
-        if file:
-            try:
-                file_text = await extract_file_content(file)
-                full_prompt = f"{prompt}\n\nHere's the file content:\n\n{file_text}"
-            except Exception as file_error:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Error processing file: {str(file_error)}"
-                )
-        else:
-            full_prompt = prompt
+        # The file is indexed with the conversation; only relevant excerpts are sent
+        model = providers.get("gpt").model
+        turn = await prepare_turn(documents, prompt, conversation_id, model, file)
 
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise HTTPException(
-                status_code=500, 
-                detail="OPENAI_API_KEY not found in environment variables"
-            )
-        client = OpenAI(api_key=api_key)
-        messages = [{"role": "user", "content": full_prompt}]
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            temperature=temperature
+        system, messages, prompt_tokens = await build_messages(
+            turn.content, conversation_id, model, reference=turn.reference
         )
+        completion = await until_cancelled(request, providers.complete(
+            "gpt", messages, temperature, system, routing=routing, prompt_tokens=prompt_tokens
+        ))
+        await save_history(conversation_id, turn.stored, completion.text, turn.attachments)
         return JSONResponse(content={
-            "text": response.choices[0].message.content,
-            "model": "gpt-4",
+            "text": completion.text,
+            "model": completion.model,
             "timestamp": datetime.now().isoformat()
-        })
+        }, headers=server_timing(turn.document))
     except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error generating response: {str(e)}"
-        )
\ No newline at end of file
+        raise upstream_error(e)
\ No newline at end of file
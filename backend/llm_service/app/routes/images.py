@@ -0,0 +1,84 @@
+import mimetypes
+import os
+import re
+
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+from app.blobs import BlobStore, get_blob_store
+
+imagesRouter = APIRouter(prefix="/images", tags=["images"])
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header: str, size: int):
+    # Only single ranges are supported; anything else gets the whole file
+    match = _RANGE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+async def read_file(path: str, start: int, end: int):
+    remaining = end - start + 1
+    async with await anyio.open_file(path, "rb") as f:
+        await f.seek(start)
+        while remaining > 0:
+            chunk = await f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+@imagesRouter.get("/{name}", name="get_image")
+async def get_image(name: str, request: Request, blobs: BlobStore = Depends(get_blob_store)):
+    path = blobs.path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    size = os.path.getsize(path)
+    etag = f'"{name.split(".")[0]}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # Content-addressed, so the bytes behind a name never change
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    if "range" in request.headers and request.headers.get("if-range", etag) == etag:
+        byte_range = parse_range(request.headers["range"], size)
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(read_file(path, 0, size - 1), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        read_file(path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers=headers
+    )
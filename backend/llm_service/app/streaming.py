@@ -0,0 +1,168 @@
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Union
+
+from fastapi.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StreamModel:
+    """Names the model answering a stream, when that may not be the requested one."""
+    model: str
+
+
+# A provider stream yields text deltas, then (at most once) a usage dict;
+# a hedged stream starts with the StreamModel of whichever provider won
+StreamItem = Union[str, Dict[str, int], StreamModel]
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _field(obj: Any, name: str) -> Any:
+    # Extra fields on SDK models (e.g. usage on older SDKs) come back as raw dicts
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def usage_dict(
+    prompt_tokens: Optional[int],
+    completion_tokens: Optional[int],
+    cache_read_tokens: Optional[int] = None,
+    cache_write_tokens: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    Token usage in one shape for every provider. `prompt_tokens` counts all
+    input, cached or not; the cache fields are only present when the
+    upstream reports them.
+    """
+    prompt_tokens = prompt_tokens or 0
+    completion_tokens = completion_tokens or 0
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    if cache_read_tokens is not None:
+        usage["cache_read_tokens"] = cache_read_tokens
+    if cache_write_tokens is not None:
+        usage["cache_write_tokens"] = cache_write_tokens
+    return usage
+
+
+def anthropic_usage(usage: Any, output_tokens: Optional[int] = None) -> Dict[str, int]:
+    # Anthropic counts cached input apart from `input_tokens`
+    cache_read = _field(usage, "cache_read_input_tokens")
+    cache_write = _field(usage, "cache_creation_input_tokens")
+    return usage_dict(
+        (_field(usage, "input_tokens") or 0) + (cache_read or 0) + (cache_write or 0),
+        output_tokens if output_tokens is not None else _field(usage, "output_tokens"),
+        cache_read,
+        cache_write,
+    )
+
+
+def openai_usage(usage: Any) -> Dict[str, int]:
+    # Prefix caching is automatic on OpenAI; hits are reported, writes are not
+    return usage_dict(
+        _field(usage, "prompt_tokens"),
+        _field(usage, "completion_tokens"),
+        _field(_field(usage, "prompt_tokens_details"), "cached_tokens"),
+    )
+
+
+async def openai_token_stream(client, **params) -> AsyncIterator[StreamItem]:
+    """Stream a chat completion from an OpenAI-compatible client (OpenAI, Groq)."""
+    stream = await client.chat.completions.create(stream=True, **params)
+    usage = None
+    async for chunk in stream:
+        for choice in chunk.choices or []:
+            text = _field(choice.delta, "content")
+            if text:
+                yield text
+        # OpenAI sends usage on a trailing chunk, Groq under x_groq on the last one
+        chunk_usage = _field(chunk, "usage") or _field(_field(chunk, "x_groq"), "usage")
+        if chunk_usage:
+            usage = openai_usage(chunk_usage)
+    if usage:
+        yield usage
+
+
+async def anthropic_token_stream(client, **params) -> AsyncIterator[StreamItem]:
+    """Stream a message from an Anthropic client."""
+    # Usage is read from the raw events: input and cache tokens come with
+    # message_start, output tokens with message_delta (which the SDK's final
+    # message does not pick up)
+    usage = None
+    output_tokens = None
+    async with client.messages.stream(**params) as stream:
+        async for event in stream:
+            if event.type == "content_block_delta":
+                text = _field(event.delta, "text")
+                if text:
+                    yield text
+            elif event.type == "message_start":
+                usage = event.message.usage
+            elif event.type == "message_delta":
+                output_tokens = _field(_field(event, "usage"), "output_tokens")
+    if usage is not None or output_tokens is not None:
+        yield anthropic_usage(usage, output_tokens)
+
+
+def sse_response(
+    tokens: AsyncIterator[StreamItem],
+    model: str,
+    on_complete: Optional[Callable[[str], Union[None, Awaitable[None]]]] = None,
+) -> StreamingResponse:
+    """
+    Relay a provider stream to the client as server-sent events.
+
+    Each text delta is sent as a `token` event and the stream ends with a
+    `done` event carrying model, timestamp and usage. The model is `model`
+    unless the stream names another one. `on_complete` receives the full
+    text once the stream has finished, and is not called if the stream fails.
+    """
+    async def events():
+        parts = []
+        usage = None
+        answered_by = model
+        try:
+            async for item in tokens:
+                if isinstance(item, dict):
+                    usage = item
+                    continue
+                if isinstance(item, StreamModel):
+                    answered_by = item.model
+                    continue
+                parts.append(item)
+                yield sse_event("token", {"text": item})
+        except Exception as e:
+            logger.error(f"Error streaming from {model}: {str(e)}")
+            yield sse_event("error", {"detail": f"Error generating response: {str(e)}"})
+            return
+
+        text = "".join(parts)
+        if on_complete is not None:
+            result = on_complete(text)
+            if result is not None:
+                await result
+
+        yield sse_event("done", {
+            "model": answered_by,
+            "timestamp": datetime.now().isoformat(),
+            "usage": usage,
+        })
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
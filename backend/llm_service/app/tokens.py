@@ -0,0 +1,22 @@
+import re
+
+# Providers each use their own tokenizer; this approximates all of them closely
+# enough for budgeting without pulling in a tokenizer dependency
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+# Chat formatting adds a few tokens per message on top of the content
+MESSAGE_TOKEN_OVERHEAD = 4
+
+CHARS_PER_TOKEN = 4
+
+
+def count_tokens(text: str) -> int:
+    # Long words split into several tokens, roughly one per four characters
+    tokens = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        tokens += 1 + (len(piece) - 1) // CHARS_PER_TOKEN
+    return tokens
+
+
+def count_message_tokens(content: str) -> int:
+    return count_tokens(content) + MESSAGE_TOKEN_OVERHEAD
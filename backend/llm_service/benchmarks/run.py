@@ -0,0 +1,337 @@
+"""
+Load-test the service offline, against local stub providers.
+
+Starts the stub providers and the service (`python -m app.main`) as separate
+processes, drives a request mix at each concurrency level, and reports
+throughput, latency percentiles and the service's peak RSS. Results are
+saved as JSON so runs can be compared:
+
+    python -m benchmarks.run --scenario mixed --concurrency 1,8,32 --label before
+    python -m benchmarks.run --compare benchmarks/results/before.json benchmarks/results/after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import httpx
+
+from benchmarks.stub_providers import StubConfig
+from benchmarks.workload import SCENARIOS, Sample, User, WorkloadConfig, make_pdf, run_user
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(SERVICE_DIR, "benchmarks", "results")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode} before it came up")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+@contextmanager
+def _process(
+    args: List[str],
+    health_url: str,
+    env: Optional[Dict[str, str]] = None,
+    quiet: bool = True,
+) -> Iterator[subprocess.Popen]:
+    output = subprocess.DEVNULL if quiet else None
+    process = subprocess.Popen(args, cwd=SERVICE_DIR, env=env, stdout=output, stderr=output)
+    try:
+        _wait_until_up(health_url, process)
+        yield process
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def _descendants(pid: int) -> List[int]:
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children + [grandchild for child in children for grandchild in _descendants(child)]
+
+
+def _rss_bytes(pid: int) -> int:
+    """Resident memory of `pid` and all its descendants (e.g. extraction workers). Linux only."""
+    total = 0
+    for process in [pid] + _descendants(pid):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+async def _sample_rss(pid: int, peak: List[int], interval: float = 0.1):
+    while True:
+        peak[0] = max(peak[0], _rss_bytes(pid))
+        await asyncio.sleep(interval)
+
+
+def _percentiles(values: Sequence[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99)}
+
+
+def _summarize(samples: List[Sample], seconds: float) -> dict:
+    ok = [sample for sample in samples if sample.ok]
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "throughput_rps": round(len(ok) / seconds, 2),
+        "latency_ms": _percentiles([sample.seconds for sample in ok]),
+        "ttft_ms": _percentiles([sample.ttft for sample in ok if sample.ttft is not None]),
+    }
+
+
+async def run_level(
+    base_url: str,
+    pid: int,
+    scenario: str,
+    concurrency: int,
+    duration: float,
+    workload: WorkloadConfig,
+    seed: int,
+) -> dict:
+    documents = [make_pdf(workload.pdf_pages, seed=i) for i in range(workload.pdf_variants)]
+    users = [User(i, random.Random(seed + i), workload, documents) for i in range(concurrency)]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    peak = [0]
+    sampler = asyncio.create_task(_sample_rss(pid, peak))
+    started = time.perf_counter()
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=workload.timeout, limits=limits) as client:
+            deadline = started + duration
+            await asyncio.gather(*(run_user(client, user, SCENARIOS[scenario], deadline) for user in users))
+    finally:
+        sampler.cancel()
+    # Requests in flight at the deadline finish, so measure the real span
+    elapsed = time.perf_counter() - started
+
+    samples = [sample for user in users for sample in user.samples]
+    by_kind = {}
+    for kind in SCENARIOS[scenario]:
+        kind_samples = [sample for sample in samples if sample.kind == kind]
+        if kind_samples:
+            by_kind[kind] = _summarize(kind_samples, elapsed)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 2),
+        **_summarize(samples, elapsed),
+        "peak_rss_mb": round(peak[0] / 2 ** 20, 1),
+        "by_kind": by_kind,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SERVICE_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format_ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.0f}"
+
+
+def print_results(results: List[dict]):
+    print(f"{'scenario':<9} {'conc':>5} {'reqs':>6} {'errs':>5} {'rps':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'ttft95':>7} {'rss MB':>7}")
+    for row in results:
+        latency = row["latency_ms"]
+        print(
+            f"{row['scenario']:<9} {row['concurrency']:>5} {row['requests']:>6} {row['errors']:>5} "
+            f"{row['throughput_rps']:>8.2f} {_format_ms(latency['p50']):>7} {_format_ms(latency['p95']):>7} "
+            f"{_format_ms(latency['p99']):>7} {_format_ms(row['ttft_ms']['p95']):>7} {row['peak_rss_mb']:>7.1f}"
+        )
+
+
+def _change(before: Optional[float], after: Optional[float]) -> str:
+    if not before or after is None:
+        return "-"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def compare(baseline_path: str, candidate_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+    rows = {(row["scenario"], row["concurrency"]): row for row in baseline["results"]}
+    print(f"{baseline.get('label')} ({baseline.get('commit')}) -> {candidate.get('label')} ({candidate.get('commit')})")
+    print(f"{'scenario':<9} {'conc':>5} {'rps':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'rss':>9} {'errors':>9}")
+    for row in candidate["results"]:
+        before = rows.get((row["scenario"], row["concurrency"]))
+        if before is None:
+            continue
+        print(
+            f"{row['scenario']:<9} {row['concurrency']:>5} "
+            f"{_change(before['throughput_rps'], row['throughput_rps']):>9} "
+            f"{_change(before['latency_ms']['p50'], row['latency_ms']['p50']):>9} "
+            f"{_change(before['latency_ms']['p95'], row['latency_ms']['p95']):>9} "
+            f"{_change(before['latency_ms']['p99'], row['latency_ms']['p99']):>9} "
+            f"{_change(before['peak_rss_mb'], row['peak_rss_mb']):>9} "
+            f"{before['errors']:>4}->{row['errors']:<4}"
+        )
+
+
+def main():
+    stub_defaults = StubConfig()
+    workload_defaults = WorkloadConfig()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", default="mixed", help=f"Comma-separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per level")
+    parser.add_argument("--label", default=None, help="Name for the saved results")
+    parser.add_argument("--output", default=None, help="Results file (default benchmarks/results/<label>.json)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1, help="Service worker processes")
+    parser.add_argument("--verbose", action="store_true", help="Show the service's and stubs' logs")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"), help="Compare two results files and exit")
+    stub = parser.add_argument_group("stub providers")
+    stub.add_argument("--latency", type=float, default=stub_defaults.latency, help="Seconds to first token")
+    stub.add_argument("--tokens-per-second", type=float, default=stub_defaults.tokens_per_second)
+    stub.add_argument("--reply-tokens", type=int, default=stub_defaults.reply_tokens)
+    stub.add_argument("--image-latency", type=float, default=stub_defaults.image_latency)
+    stub.add_argument(
+        "--prefill-tokens-per-second", type=float, default=stub_defaults.prefill_tokens_per_second,
+        help="Uncached input processed per second; 0 makes input free"
+    )
+    load = parser.add_argument_group("workload")
+    load.add_argument("--chat-turns", type=int, default=workload_defaults.chat_turns)
+    load.add_argument("--prompt-words", type=int, default=workload_defaults.prompt_words)
+    load.add_argument("--pdf-pages", type=int, default=workload_defaults.pdf_pages)
+    load.add_argument("--batch-items", type=int, default=workload_defaults.batch_items)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    scenarios = args.scenario.split(",")
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+    workload = WorkloadConfig(
+        chat_turns=args.chat_turns,
+        prompt_words=args.prompt_words,
+        pdf_pages=args.pdf_pages,
+        batch_items=args.batch_items,
+    )
+
+    stub_port = _free_port()
+    service_port = _free_port()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "bench",
+        "ANTHROPIC_API_KEY": "bench",
+        "GROQ_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{stub_url}/v1",
+        "ANTHROPIC_BASE_URL": stub_url,
+        "GROQ_BASE_URL": stub_url,
+    }
+    stub_args = [
+        sys.executable, "-m", "benchmarks.stub_providers",
+        "--port", str(stub_port),
+        "--latency", str(args.latency),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--reply-tokens", str(args.reply_tokens),
+        "--image-latency", str(args.image_latency),
+        "--prefill-tokens-per-second", str(args.prefill_tokens_per_second),
+    ]
+    service_args = [
+        sys.executable, "-m", "app.main",
+        "--host", "127.0.0.1", "--port", str(service_port), "--workers", str(args.workers),
+    ]
+    # Fresh shared history per run, removed afterwards
+    state_dir = tempfile.TemporaryDirectory(prefix="bench-")
+    env["CONVERSATION_DB_PATH"] = os.path.join(state_dir.name, "conversations.db")
+
+    results = []
+    quiet = not args.verbose
+    with state_dir, _process(stub_args, f"{stub_url}/health", quiet=quiet), \
+            _process(service_args, f"http://127.0.0.1:{service_port}/stats", env, quiet=quiet) as service:
+        for scenario in scenarios:
+            for concurrency in levels:
+                print(f"Running {scenario} at concurrency {concurrency} for {args.duration:.0f}s...", flush=True)
+                results.append(asyncio.run(run_level(
+                    f"http://127.0.0.1:{service_port}",
+                    service.pid,
+                    scenario,
+                    concurrency,
+                    args.duration,
+                    workload,
+                    args.seed,
+                )))
+
+    print_results(results)
+
+    label = args.label or datetime.now().strftime("%Y%m%d-%H%M%S")
+    output = args.output or os.path.join(RESULTS_DIR, f"{label}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "label": label,
+            "commit": _git_commit(),
+            "timestamp": datetime.now().isoformat(),
+            "duration": args.duration,
+            "workers": args.workers,
+            "stub": {
+                "latency": args.latency,
+                "tokens_per_second": args.tokens_per_second,
+                "reply_tokens": args.reply_tokens,
+                "image_latency": args.image_latency,
+                "prefill_tokens_per_second": args.prefill_tokens_per_second,
+            },
+            "workload": vars(workload),
+            "results": results,
+        }, f, indent=2)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
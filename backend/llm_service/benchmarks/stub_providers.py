@@ -0,0 +1,305 @@
+"""
+Stand-in for the OpenAI, Anthropic and Groq APIs, for benchmarking offline.
+
+Serves the chat (plain and streamed), messages and image endpoints the
+service calls, with a configurable time to first token, token rate and
+reply length. The messages endpoint imitates Anthropic prompt caching: it
+checks the `cache_control` markers, rejecting requests the real API would
+reject, and reports cache reads and writes. Run with
+`python -m benchmarks.stub_providers --port 9100`.
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "the service streams tokens from a model while the client waits for the reply and "
+    "every request carries history context and sometimes a document to read"
+).split()
+
+
+@dataclass
+class StubConfig:
+    # Seconds until the first token
+    latency: float = 0.3
+    tokens_per_second: float = 80.0
+    reply_tokens: int = 64
+    # Relative random variation applied to latency and token rate
+    jitter: float = 0.1
+    image_latency: float = 2.0
+    image_bytes: int = 512 * 1024
+    # Uncached input processed per second before the first token; 0 makes input free
+    prefill_tokens_per_second: float = 0.0
+
+
+# Anthropic's limits: breakpoints per request, shortest cacheable prefix,
+# entry lifetime, and how many blocks before a breakpoint are checked for a hit
+CACHE_MAX_BREAKPOINTS = 4
+CACHE_MIN_TOKENS = 1024
+CACHE_TTL = 300.0
+CACHE_LOOKBACK_BLOCKS = 20
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _estimate_tokens(payload) -> int:
+    return max(1, len(json.dumps(payload)) // 4)
+
+
+def _blocks(body) -> List[Tuple[str, dict]]:
+    """The request's system and message content as a flat list of (role, block)."""
+    blocks = []
+    system = body.get("system")
+    if isinstance(system, str):
+        blocks.append(("system", {"type": "text", "text": system}))
+    elif system:
+        blocks.extend(("system", block) for block in system)
+    for message in body.get("messages", []):
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        blocks.extend((message["role"], block) for block in content)
+    return blocks
+
+
+class PromptCache:
+    """Prefix cache keyed by a hash of everything up to a breakpoint, as the real API does."""
+
+    def __init__(self):
+        self._entries: Dict[str, float] = {}
+
+    def usage(self, body) -> Dict[str, int]:
+        blocks = _blocks(body)
+        breakpoints = []
+        for i, (_, block) in enumerate(blocks):
+            marker = block.get("cache_control")
+            if marker is None:
+                continue
+            if marker != {"type": "ephemeral"}:
+                raise BadRequest(f"cache_control type must be 'ephemeral', got {marker}")
+            breakpoints.append(i)
+        if len(breakpoints) > CACHE_MAX_BREAKPOINTS:
+            raise BadRequest(
+                f"A maximum of {CACHE_MAX_BREAKPOINTS} blocks with cache_control may be provided. Found {len(breakpoints)}."
+            )
+
+        # Markers are not part of the prefix, so moving them does not invalidate it
+        hashes, tokens = [], []
+        digest = hashlib.sha256()
+        total = 0
+        for role, block in blocks:
+            digest.update(json.dumps([role, {k: v for k, v in block.items() if k != "cache_control"}]).encode())
+            hashes.append(digest.hexdigest())
+            total += _estimate_tokens(block.get("text", block))
+            tokens.append(total)
+
+        now = time.monotonic()
+        read = 0
+        for i in breakpoints:
+            for j in range(i, max(-1, i - CACHE_LOOKBACK_BLOCKS), -1):
+                if self._entries.get(hashes[j], 0) > now:
+                    self._entries[hashes[j]] = now + CACHE_TTL
+                    read = max(read, tokens[j])
+                    break
+        written = 0
+        for i in breakpoints:
+            if tokens[i] >= CACHE_MIN_TOKENS and self._entries.get(hashes[i], 0) <= now:
+                self._entries[hashes[i]] = now + CACHE_TTL
+                written = max(written, tokens[i])
+        write = max(0, written - read)
+        return {
+            "input_tokens": total - read - write,
+            "cache_read_input_tokens": read,
+            "cache_creation_input_tokens": write,
+        }
+
+
+def create_stub_app(config: StubConfig) -> FastAPI:
+    app = FastAPI(title="Stub providers")
+    prompt_cache = PromptCache()
+    image_ids = itertools.count()
+    image_base = random.Random(0).randbytes(config.image_bytes)
+
+    def jittered(value: float) -> float:
+        return value * random.uniform(1 - config.jitter, 1 + config.jitter)
+
+    def reply_words():
+        return [random.choice(WORDS) + " " for _ in range(config.reply_tokens)]
+
+    def prefill(input_tokens: int) -> float:
+        return input_tokens / config.prefill_tokens_per_second if config.prefill_tokens_per_second else 0.0
+
+    async def generation_delay(input_tokens: int = 0):
+        await asyncio.sleep(
+            prefill(input_tokens) + jittered(config.latency) + config.reply_tokens / jittered(config.tokens_per_second)
+        )
+
+    async def paced(words, input_tokens: int = 0):
+        await asyncio.sleep(prefill(input_tokens) + jittered(config.latency))
+        interval = 1 / jittered(config.tokens_per_second)
+        for word in words:
+            yield word
+            await asyncio.sleep(interval)
+
+    def usage(body):
+        prompt = _estimate_tokens(body.get("messages", []))
+        return {"prompt_tokens": prompt, "completion_tokens": config.reply_tokens, "total_tokens": prompt + config.reply_tokens}
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        words = reply_words()
+        model = body["model"]
+        if not body.get("stream"):
+            await generation_delay(usage(body)["prompt_tokens"])
+            return {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(words)},
+                    "finish_reason": "stop",
+                    "logprobs": None,
+                }],
+                "usage": usage(body),
+            }
+
+        def chunk(choices, **extra):
+            return "data: " + json.dumps({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+                **extra,
+            }) + "\n\n"
+
+        async def events():
+            async for word in paced(words, usage(body)["prompt_tokens"]):
+                yield chunk([{"index": 0, "delta": {"content": word}, "finish_reason": None}])
+            final = [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+            # Groq reports usage under x_groq, OpenAI on a trailing chunk when asked
+            yield chunk(final, x_groq={"usage": usage(body)})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield chunk([], usage=usage(body))
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    app.post("/v1/chat/completions")(chat_completions)
+    app.post("/openai/v1/chat/completions")(chat_completions)
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        words = reply_words()
+        model = body["model"]
+        try:
+            usage = prompt_cache.usage(body)
+        except BadRequest as e:
+            return JSONResponse(
+                {"type": "error", "error": {"type": "invalid_request_error", "message": str(e)}},
+                status_code=400,
+            )
+        # Cache reads skip the prefill; writes cost as much as uncached input
+        uncached = usage["input_tokens"] + usage["cache_creation_input_tokens"]
+        if not body.get("stream"):
+            await generation_delay(uncached)
+            return {
+                "id": "msg_stub",
+                "type": "message",
+                "role": "assistant",
+                "model": model,
+                "content": [{"type": "text", "text": "".join(words)}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {**usage, "output_tokens": config.reply_tokens},
+            }
+
+        def event(name, data):
+            return f"event: {name}\ndata: {json.dumps({'type': name, **data})}\n\n"
+
+        async def events():
+            yield event("message_start", {"message": {
+                "id": "msg_stub", "type": "message", "role": "assistant", "model": model, "content": [],
+                "stop_reason": None, "stop_sequence": None,
+                "usage": {**usage, "output_tokens": 0},
+            }})
+            yield event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+            async for word in paced(words, uncached):
+                yield event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": word}})
+            yield event("content_block_stop", {"index": 0})
+            yield event("message_delta", {
+                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                "usage": {"output_tokens": config.reply_tokens},
+            })
+            yield event("message_stop", {})
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/images/generations")
+    async def images(request: Request):
+        body = await request.json()
+        await asyncio.sleep(jittered(config.image_latency))
+        base_url = str(request.base_url).rstrip("/")
+        return {
+            "created": int(time.time()),
+            "data": [
+                {"url": f"{base_url}/files/{next(image_ids)}.png", "revised_prompt": body["prompt"]}
+                for _ in range(body.get("n") or 1)
+            ],
+        }
+
+    @app.get("/files/{image_id}.png")
+    async def image_file(image_id: int):
+        # Distinct bytes per image, so the blob store cannot deduplicate them
+        return Response(image_base + image_id.to_bytes(8, "big"), media_type="image/png")
+
+    @app.get("/health")
+    async def health():
+        return JSONResponse({"ok": True})
+
+    return app
+
+
+def main():
+    defaults = StubConfig()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="Seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=defaults.tokens_per_second)
+    parser.add_argument("--reply-tokens", type=int, default=defaults.reply_tokens)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument("--image-latency", type=float, default=defaults.image_latency)
+    parser.add_argument("--image-bytes", type=int, default=defaults.image_bytes)
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=defaults.prefill_tokens_per_second)
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        jitter=args.jitter,
+        image_latency=args.image_latency,
+        image_bytes=args.image_bytes,
+        prefill_tokens_per_second=args.prefill_tokens_per_second,
+    )
+    uvicorn.run(create_stub_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
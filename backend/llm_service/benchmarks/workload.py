@@ -0,0 +1,201 @@
+"""Request mixes the benchmark drives against the service."""
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+PROVIDERS = ("gpt", "claude", "llama")
+
+# Relative weight of each request kind in a scenario
+SCENARIOS: Dict[str, Dict[str, int]] = {
+    "chat": {"chat": 1},
+    "stream": {"stream": 1},
+    "pdf": {"pdf": 1},
+    "image": {"image": 1},
+    "batch": {"batch": 1},
+    "mixed": {"chat": 50, "stream": 25, "pdf": 10, "image": 5, "batch": 10},
+}
+
+FILLER = (
+    "Please look at the following notes and explain what they mean for the rollout plan, "
+    "which teams are affected, and what we should check before the next release. "
+).split()
+
+
+def make_pdf(pages: int, words_per_page: int = 300, seed: int = 0) -> bytes:
+    """A minimal valid PDF with `pages` pages of text, without a PDF library."""
+    rng = random.Random(seed)
+    font_id = 3 + 2 * pages
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join(f"{3 + 2 * i} 0 R" for i in range(pages)), pages
+        ),
+    ]
+    for i in range(pages):
+        text = " ".join(rng.choice(FILLER) for _ in range(words_per_page))
+        stream = f"BT /F1 10 Tf 20 700 Td ({text}) Tj ET"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * i} 0 R "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>"
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+
+
+@dataclass
+class Sample:
+    kind: str
+    seconds: float
+    ok: bool
+    # Streams only: seconds until the first token event
+    ttft: Optional[float] = None
+
+
+@dataclass
+class WorkloadConfig:
+    # Turns a simulated user has in one conversation before starting a new one
+    chat_turns: int = 20
+    prompt_words: int = 120
+    pdf_pages: int = 40
+    # Distinct documents in rotation; repeats exercise the document cache
+    pdf_variants: int = 4
+    batch_items: int = 20
+    timeout: float = 120.0
+
+
+@dataclass
+class User:
+    """One simulated client, issuing requests back to back."""
+
+    id: int
+    rng: random.Random
+    config: WorkloadConfig
+    documents: List[bytes]
+    conversation: int = 0
+    turn: int = 0
+    samples: List[Sample] = field(default_factory=list)
+
+    def prompt(self) -> str:
+        words = " ".join(self.rng.choice(FILLER) for _ in range(self.config.prompt_words))
+        # Unique per request, so neither the response cache nor coalescing kicks in
+        return f"[user {self.id} turn {self.turn}] {words}"
+
+    def conversation_id(self) -> str:
+        self.turn += 1
+        if self.turn > self.config.chat_turns:
+            self.conversation += 1
+            self.turn = 1
+        return f"bench-{self.id}-{self.conversation}"
+
+
+async def _timed(user: User, kind: str, call: Callable[[], Awaitable[bool]]):
+    started = time.perf_counter()
+    try:
+        ok = await call()
+    except httpx.HTTPError:
+        ok = False
+    user.samples.append(Sample(kind, time.perf_counter() - started, ok))
+
+
+async def chat(client: httpx.AsyncClient, user: User):
+    provider = user.rng.choice(PROVIDERS)
+    conversation_id = user.conversation_id()
+    path = "/claude/generate-json" if provider == "claude" else f"/{provider}/generate"
+
+    async def call():
+        response = await client.post(path, json={"prompt": user.prompt(), "conversation_id": conversation_id})
+        return response.status_code == 200
+
+    await _timed(user, "chat", call)
+
+
+async def stream(client: httpx.AsyncClient, user: User):
+    provider = user.rng.choice(PROVIDERS)
+    conversation_id = user.conversation_id()
+    path = "/claude/generate-json-stream" if provider == "claude" else f"/{provider}/generate-stream"
+    started = time.perf_counter()
+    ttft = None
+    ok = False
+    try:
+        async with client.stream("POST", path, json={"prompt": user.prompt(), "conversation_id": conversation_id}) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("event: token") and ttft is None:
+                    ttft = time.perf_counter() - started
+                elif line.startswith("event: done"):
+                    ok = response.status_code == 200
+                elif line.startswith("event: error"):
+                    break
+    except httpx.HTTPError:
+        pass
+    user.samples.append(Sample("stream", time.perf_counter() - started, ok, ttft))
+
+
+async def pdf(client: httpx.AsyncClient, user: User):
+    document = user.rng.choice(user.documents)
+    conversation_id = user.conversation_id()
+
+    async def call():
+        response = await client.post(
+            "/claude/generate",
+            data={"prompt": "Summarize this document.", "conversation_id": conversation_id},
+            files={"file": ("report.pdf", document, "application/pdf")},
+        )
+        return response.status_code == 200
+
+    await _timed(user, "pdf", call)
+
+
+async def image(client: httpx.AsyncClient, user: User):
+    async def call():
+        response = await client.post("/gpt/generate", json={"prompt": f"/image a lighthouse, variant {user.rng.random()}"})
+        return response.status_code == 200
+
+    await _timed(user, "image", call)
+
+
+async def batch(client: httpx.AsyncClient, user: User):
+    items = [
+        {"provider": user.rng.choice(PROVIDERS), "prompt": user.prompt(), "id": str(i)}
+        for i in range(user.config.batch_items)
+    ]
+
+    async def call():
+        async with client.stream("POST", "/batch/generate", json={"items": items}) as response:
+            if response.status_code != 200:
+                return False
+            results = [json.loads(line) async for line in response.aiter_lines() if line]
+        return len(results) == len(items) and not any("error" in result for result in results)
+
+    await _timed(user, "batch", call)
+
+
+REQUESTS: Dict[str, Callable[[httpx.AsyncClient, User], Awaitable[None]]] = {
+    "chat": chat,
+    "stream": stream,
+    "pdf": pdf,
+    "image": image,
+    "batch": batch,
+}
+
+
+async def run_user(client: httpx.AsyncClient, user: User, mix: Dict[str, int], deadline: float):
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    while time.perf_counter() < deadline:
+        kind = user.rng.choices(kinds, weights)[0]
+        await REQUESTS[kind](client, user)
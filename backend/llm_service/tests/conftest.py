@@ -0,0 +1,22 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeChatCompletions:
+    """Stands in for `client.chat.completions` of the OpenAI and Groq SDKs."""
+
+    def __init__(self, reply: str = "ok"):
+        self.reply = reply
+        self.calls = []
+
+    async def create(self, **params):
+        self.calls.append(params)
+        message = SimpleNamespace(content=self.reply)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.fixture
+def fake_chat_client():
+    completions = FakeChatCompletions()
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.admission import BATCH, IMAGE, INTERACTIVE, Scheduler
+
+
+def test_queued_requests_are_admitted_interactive_then_batch_then_image():
+    async def run():
+        scheduler = Scheduler("test", max_concurrency=1)
+        await scheduler.acquire()
+        order = []
+
+        async def request(name, priority):
+            async with scheduler.slot(priority=priority):
+                order.append(name)
+
+        # Queued in the reverse of the order they should run in
+        tasks = [
+            asyncio.create_task(request("image", IMAGE)),
+            asyncio.create_task(request("batch", BATCH)),
+            asyncio.create_task(request("interactive", INTERACTIVE)),
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == 3
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return order, scheduler.stats()
+
+    order, stats = asyncio.run(run())
+
+    assert order == ["interactive", "batch", "image"]
+    assert stats["in_flight"] == stats["queued"] == 0
+
+
+def test_full_queue_is_rejected_with_429_and_retry_after():
+    async def run():
+        scheduler = Scheduler("test", max_concurrency=1, queue_size=1)
+        await scheduler.acquire()
+        waiter = asyncio.create_task(scheduler.acquire())
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(HTTPException) as rejected:
+                await scheduler.acquire()
+        finally:
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+        return rejected.value, scheduler.stats()
+
+    error, stats = asyncio.run(run())
+
+    assert error.status_code == 429
+    assert int(error.headers["Retry-After"]) >= 1
+    assert stats["rejected"] == 1
+
+
+def test_request_admitted_as_its_wait_times_out_still_releases_its_slot(monkeypatch):
+    scheduler = Scheduler("test", max_concurrency=1)
+
+    async def admitted_as_the_wait_times_out(awaitable, timeout):
+        # The slot frees up and is handed to the waiter in the same moment
+        # its timeout fires
+        scheduler.release()
+        awaitable.cancel()
+        raise asyncio.TimeoutError
+
+    async def run():
+        await scheduler.acquire()
+        monkeypatch.setattr(asyncio, "wait_for", admitted_as_the_wait_times_out)
+        async with scheduler.slot(timeout=1.0):
+            assert scheduler.in_flight == 1
+        monkeypatch.undo()
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+
+    assert stats["in_flight"] == stats["queued"] == 0
+    assert stats["admitted"] == 2
+    assert stats["timed_out"] == 0
+
+
+def test_request_that_times_out_in_the_queue_gets_503_and_leaves_it():
+    async def run():
+        scheduler = Scheduler("test", max_concurrency=1)
+        await scheduler.acquire()
+        with pytest.raises(HTTPException) as timed_out:
+            await scheduler.acquire(timeout=0.01)
+        scheduler.release()
+        return timed_out.value, scheduler.stats()
+
+    error, stats = asyncio.run(run())
+
+    assert error.status_code == 503
+    assert "Retry-After" in error.headers
+    assert stats == {"in_flight": 0, "queued": 0, "admitted": 1, "rejected": 0, "timed_out": 1}
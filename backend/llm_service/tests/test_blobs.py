@@ -0,0 +1,29 @@
+import asyncio
+import os
+
+import httpx
+
+from app.blobs import BlobStore
+
+
+def image_server(request: httpx.Request) -> httpx.Response:
+    # Each URL serves 1000 distinct bytes
+    body = request.url.path.encode().ljust(1000, b"\0")
+    return httpx.Response(200, content=body, headers={"content-type": "image/png"})
+
+
+def test_oldest_blobs_are_evicted_over_the_size_limit(tmp_path):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(image_server)) as http:
+            blobs = BlobStore(http, str(tmp_path), max_bytes=2500)
+            names = []
+            for i in range(4):
+                names.append(await blobs.fetch(f"http://images.test/{i}.png"))
+                # mtime decides eviction order
+                os.utime(tmp_path / names[-1], (i, i))
+            return blobs, names
+
+    blobs, names = asyncio.run(run())
+
+    assert [blobs.path(name) is not None for name in names] == [False, False, True, True]
+    assert blobs.size == 2000
@@ -0,0 +1,17 @@
+import asyncio
+
+from app.cache import TieredCache
+
+
+def test_overwriting_a_key_keeps_the_disk_size_accurate(tmp_path):
+    async def run():
+        cache = TieredCache(str(tmp_path), memory_bytes=10_000, disk_bytes=10_000)
+        for _ in range(5):
+            await cache.put("a" * 64, {"text": "x" * 100})
+        await cache.put("a" * 64, {"text": "short"})
+        return cache
+
+    cache = asyncio.run(run())
+
+    on_disk = sum(path.stat().st_size for path in tmp_path.glob("*.json"))
+    assert cache.stats()["disk_bytes"] == on_disk
@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Request
+
+from app.cancellation import (
+    CLIENT_CLOSED_REQUEST,
+    TIMEOUT_HEADER,
+    request_deadline,
+    until_cancelled,
+    with_deadline,
+)
+
+
+def make_request(timeout=None, arrived_ago: float = 0.0, disconnect_after=None) -> Request:
+    """A request as a handler sees it, disconnecting after `disconnect_after` seconds if given."""
+    headers = [] if timeout is None else [(TIMEOUT_HEADER.lower().encode(), timeout.encode())]
+
+    async def receive():
+        if disconnect_after is None:
+            await asyncio.Event().wait()
+        await asyncio.sleep(disconnect_after)
+        return {"type": "http.disconnect"}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "scheme": "http",
+        "server": ("test", 80),
+        "path": "/gpt/generate",
+        "query_string": b"",
+        "headers": headers,
+        "state": {"arrived_at": asyncio.get_running_loop().time() - arrived_ago},
+    }
+    return Request(scope, receive)
+
+
+class Upstream:
+    """An upstream call taking `delay` seconds, noting whether it was cancelled."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.cancelled = False
+        self.closed = False
+
+    async def call(self):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return "done"
+
+    async def stream(self):
+        try:
+            for token in ("a", "b", "c"):
+                await asyncio.sleep(self.delay)
+                yield token
+        finally:
+            self.closed = True
+
+
+def test_deadline_counts_from_arrival():
+    async def run():
+        request = make_request("10", arrived_ago=4.0)
+        return request_deadline(request) - asyncio.get_running_loop().time()
+
+    assert 5.9 < asyncio.run(run()) <= 6.0
+
+
+def test_disconnect_cancels_the_call():
+    upstream = Upstream(delay=5.0)
+
+    async def run():
+        return await until_cancelled(make_request(disconnect_after=0.01), upstream.call())
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(run())
+
+    assert raised.value.status_code == CLIENT_CLOSED_REQUEST
+    assert upstream.cancelled
+
+
+def test_call_finishing_first_is_returned():
+    async def run():
+        return await until_cancelled(make_request("5"), Upstream(delay=0.01).call())
+
+    assert asyncio.run(run()) == "done"
+
+
+def test_deadline_already_passed():
+    upstream = Upstream(delay=5.0)
+
+    async def run():
+        return await until_cancelled(make_request("1", arrived_ago=2.0), upstream.call())
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(run())
+
+    assert raised.value.status_code == 504
+    assert upstream.cancelled
+
+
+def test_stream_past_its_deadline_is_closed():
+    upstream = Upstream(delay=0.05)
+
+    async def run():
+        request = make_request("0.08")
+        return [token async for token in with_deadline(upstream.stream(), request_deadline(request))]
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(run())
+
+    assert raised.value.status_code == 504
+    assert upstream.closed
+
+
+def test_stream_without_deadline_is_relayed_whole():
+    upstream = Upstream(delay=0.0)
+
+    async def run():
+        return [token async for token in with_deadline(upstream.stream(), None)]
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+    assert upstream.closed
+
+
+@pytest.mark.parametrize("timeout", ["soon", "0", "-1"])
+def test_invalid_timeout_header_is_rejected_before_calling_upstream(timeout):
+    upstream = Upstream(delay=0.0)
+    call = upstream.call()
+
+    async def run():
+        return await until_cancelled(make_request(timeout), call)
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(run())
+
+    assert raised.value.status_code == 400
+    # Closed without ever running
+    assert call.cr_frame is None and not upstream.cancelled
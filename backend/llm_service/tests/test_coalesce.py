@@ -0,0 +1,112 @@
+import asyncio
+
+from app.coalesce import Coalescer
+
+
+class Upstream:
+    """A call that runs until released, and notes whether it was cancelled."""
+
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = False
+        self.release = asyncio.Event()
+
+    async def complete(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return "reply"
+
+    async def stream(self):
+        self.calls += 1
+        try:
+            yield "first"
+            await self.release.wait()
+            yield "second"
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled = True
+            raise
+
+
+def test_cancelled_waiter_leaves_the_shared_call_running():
+    async def run():
+        coalescer = Coalescer(enabled=True)
+        upstream = Upstream()
+        first = asyncio.create_task(coalescer.run("key", upstream.complete))
+        second = asyncio.create_task(coalescer.run("key", upstream.complete))
+        await asyncio.sleep(0)
+
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        upstream.release.set()
+        return await second, first.cancelled(), upstream
+
+    (result, shared), first_cancelled, upstream = asyncio.run(run())
+
+    assert (result, shared) == ("reply", True)
+    assert first_cancelled
+    assert upstream.calls == 1
+    assert not upstream.cancelled
+
+
+def test_last_waiter_leaving_cancels_the_upstream_call():
+    async def run():
+        coalescer = Coalescer(enabled=True)
+        upstream = Upstream()
+        waiters = [asyncio.create_task(coalescer.run("key", upstream.complete)) for _ in range(3)]
+        await asyncio.sleep(0)
+
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        return coalescer, upstream
+
+    coalescer, upstream = asyncio.run(run())
+
+    assert upstream.calls == 1
+    assert upstream.cancelled
+    assert coalescer.stats()["in_flight"] == 0
+
+
+def test_stream_subscriber_leaving_early_does_not_stop_the_others():
+    async def run():
+        coalescer = Coalescer(enabled=True)
+        upstream = Upstream()
+        leaver = coalescer.stream("key", upstream.stream)
+        stayer = coalescer.stream("key", upstream.stream)
+        assert await leaver.__anext__() == "first"
+        assert await stayer.__anext__() == "first"
+
+        await leaver.aclose()
+        upstream.release.set()
+        rest = [item async for item in stayer]
+        return rest, upstream
+
+    rest, upstream = asyncio.run(run())
+
+    assert rest == ["second"]
+    assert upstream.calls == 1
+    assert not upstream.cancelled
+
+
+def test_last_stream_subscriber_leaving_cancels_the_upstream_stream():
+    async def run():
+        coalescer = Coalescer(enabled=True)
+        upstream = Upstream()
+        subscribers = [coalescer.stream("key", upstream.stream) for _ in range(2)]
+        for subscriber in subscribers:
+            assert await subscriber.__anext__() == "first"
+
+        for subscriber in subscribers:
+            await subscriber.aclose()
+        await asyncio.sleep(0)
+        return coalescer, upstream
+
+    coalescer, upstream = asyncio.run(run())
+
+    assert upstream.cancelled
+    assert coalescer.stats()["in_flight"] == 0
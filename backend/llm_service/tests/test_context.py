@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+
+import app.context
+from app.context import (
+    COMPACT_TARGET,
+    SUMMARY_HEADER,
+    SUMMARY_LINE_CHARS,
+    build_context,
+    input_budget,
+    summarize,
+    with_summary,
+)
+from app.history import ConversationStore, StoredMessage
+from app.tokens import count_message_tokens, count_tokens
+
+MODEL = "gpt-4"
+SYSTEM = "Be kind."
+KEY = "gpt:conversation"
+
+
+@pytest.fixture
+def conversations(monkeypatch):
+    store = ConversationStore()
+    monkeypatch.setattr(app.context, "conversations", store)
+    # A small budget, so a few turns go over it
+    monkeypatch.setattr(app.context, "MAX_INPUT_TOKENS", 600)
+    return store
+
+
+def user(text: str):
+    return {"role": "user", "content": text}
+
+
+def add_turns(conversations, first: int, count: int):
+    async def run():
+        for i in range(first, first + count):
+            await conversations.append(
+                KEY,
+                user(f"question {i} " + "word " * 40),
+                {"role": "assistant", "content": f"answer {i} " + "word " * 40},
+            )
+    asyncio.run(run())
+
+
+def budget_for(user_msg) -> int:
+    return input_budget(MODEL) - count_tokens(SYSTEM) - count_message_tokens(user_msg["content"])
+
+
+def test_history_over_budget_is_compacted_into_the_summary(conversations):
+    add_turns(conversations, 0, 10)
+    new = user("and now?")
+
+    context = asyncio.run(build_context(KEY, new, MODEL, SYSTEM))
+
+    budget = budget_for(new)
+    history = context.messages[:-1]
+    assert context.messages[-1] == new
+    # Trimmed to the compaction target, not just under the budget, and
+    # opening on a user turn
+    target = int(budget * COMPACT_TARGET) - min(app.context.SUMMARY_MAX_TOKENS, budget // 4)
+    assert 0 < sum(count_message_tokens(msg["content"]) for msg in history) <= target
+    assert history[0]["role"] == "user"
+    # The dropped turns live on in the summary, which the store now holds
+    first_kept = int(history[0]["content"].split()[1])
+    assert context.summary.split("\n")[-1].startswith(f"Assistant: answer {first_kept - 1} ")
+    stored = asyncio.run(conversations.get(KEY))
+    assert [msg.to_dict() for msg in stored.messages] == history
+    assert stored.summary == context.summary
+    assert stored.summary_tokens == count_tokens(context.summary)
+    # The summary goes to the model as the last system prompt section
+    system = with_summary(SYSTEM, context.summary)
+    assert system == f"{SYSTEM}\n\n{SUMMARY_HEADER}\n{context.summary}"
+    assert context.tokens == (
+        count_tokens(SYSTEM)
+        + count_tokens(context.summary)
+        + sum(count_message_tokens(msg["content"]) for msg in context.messages)
+    )
+
+
+def test_history_within_budget_is_sent_whole(conversations):
+    add_turns(conversations, 0, 2)
+
+    context = asyncio.run(build_context(KEY, user("and now?"), MODEL, SYSTEM))
+
+    assert len(context.messages) == 5
+    assert context.summary == ""
+
+
+def test_single_oversized_message(conversations):
+    asyncio.run(conversations.append(KEY, user("huge " * 2000)))
+
+    context = asyncio.run(build_context(KEY, user("and now?"), MODEL, SYSTEM))
+
+    # Nothing of the stored message fits; only its opening reaches the summary
+    assert context.messages == [user("and now?")]
+    assert context.summary == "User: " + ("huge " * 2000)[:SUMMARY_LINE_CHARS] + "..."
+
+    # A prompt bigger than the budget on its own still goes out, without history
+    add_turns(conversations, 0, 2)
+    huge = user("huge " * 2000)
+    context = asyncio.run(build_context(KEY, huge, MODEL, SYSTEM))
+
+    assert context.messages == [huge]
+
+
+def test_repeated_compaction_keeps_the_summary_bounded(conversations):
+    new = user("and now?")
+    summary_budget = min(app.context.SUMMARY_MAX_TOKENS, budget_for(new) // 4)
+    compactions = 0
+    for i in range(30):
+        add_turns(conversations, i, 1)
+        previous = asyncio.run(conversations.get(KEY)).summary
+        context = asyncio.run(build_context(KEY, new, MODEL, SYSTEM))
+        compactions += context.summary != previous
+        assert count_tokens(context.summary) <= summary_budget
+        assert context.messages[0]["role"] == "user"
+
+    assert compactions > 1
+    # Oldest turns fall out of the summary first; the newest compacted one is kept
+    first_kept = int(context.messages[0]["content"].split()[1])
+    assert "question 0 " not in context.summary
+    assert context.summary.split("\n")[-1].startswith(f"Assistant: answer {first_kept - 1} ")
+
+
+def test_summarize_keeps_the_newest_lines_within_max_tokens():
+    messages = [StoredMessage("user", f"message {i}", 4) for i in range(10)]
+
+    summary = summarize("User: earlier", messages, max_tokens=12)
+
+    assert summary == "User: message 8\nUser: message 9"
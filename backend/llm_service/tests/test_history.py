@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import pytest
+
+from app.history import MESSAGE_OVERHEAD, SQLiteConversationStore
+
+
+def turn(text: str):
+    return {"role": "user", "content": text}, {"role": "assistant", "content": f"re: {text}"}
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "conversations.db")
+
+
+def store(path: str, **limits) -> SQLiteConversationStore:
+    conversations = SQLiteConversationStore(path, **limits)
+    # Evict on every write rather than every EVICT_INTERVAL seconds
+    conversations.EVICT_INTERVAL = 0.0
+    return conversations
+
+
+def touch(conversations: SQLiteConversationStore, conversation_id: str, last_access: float):
+    conversations.db.execute("UPDATE conversations SET last_access = ? WHERE id = ?", (last_access, conversation_id))
+
+
+def test_append_and_get_round_trip(db_path):
+    conversations = store(db_path)
+
+    async def run():
+        await conversations.append("a", *turn("one"), documents=["d1"])
+        await conversations.append("a", *turn("two"), documents=["d1", "d2"])
+        return await conversations.get("a"), await conversations.documents("a")
+
+    conversation, documents = asyncio.run(run())
+
+    assert [msg.to_dict() for msg in conversation.messages] == [*turn("one"), *turn("two")]
+    assert all(msg.tokens > 0 for msg in conversation.messages)
+    assert documents == ["d1", "d2"]
+    assert conversations.size == sum(len(msg.content) + MESSAGE_OVERHEAD for msg in conversation.messages)
+
+
+def test_compact_replaces_oldest_messages_with_the_summary(db_path):
+    conversations = store(db_path)
+
+    async def run():
+        await conversations.append("a", *turn("one"), *turn("two"))
+        await conversations.compact("a", 2, "User: one", 3)
+        return await conversations.get("a")
+
+    conversation = asyncio.run(run())
+
+    assert [msg.to_dict() for msg in conversation.messages] == list(turn("two"))
+    assert (conversation.summary, conversation.summary_tokens) == ("User: one", 3)
+    kept = sum(len(msg.content) + MESSAGE_OVERHEAD for msg in conversation.messages)
+    assert conversation.size == conversations.size == kept + len("User: one")
+
+
+def test_expired_conversation_is_absent_and_restarts_on_append(db_path):
+    conversations = store(db_path, ttl=60)
+
+    async def run():
+        await conversations.append("a", *turn("one"), documents=["d1"])
+        touch(conversations, "a", time.time() - 120)
+        expired = await conversations.get("a"), await conversations.documents("a")
+        await conversations.append("a", *turn("two"))
+        return expired, await conversations.messages("a")
+
+    (conversation, documents), messages = asyncio.run(run())
+
+    assert conversation is None and documents == []
+    assert messages == list(turn("two"))
+
+
+def test_least_recently_used_conversations_go_over_the_byte_cap(db_path):
+    message_size = len("x" * 100) + MESSAGE_OVERHEAD
+    conversations = store(db_path, max_bytes=4 * message_size)
+    message = {"role": "user", "content": "x" * 100}
+
+    async def run():
+        for conversation_id in ("a", "b"):
+            await conversations.append(conversation_id, message, message)
+        touch(conversations, "a", time.time() - 20)
+        touch(conversations, "b", time.time() - 10)
+        await conversations.append("c", message)
+        return [await conversations.get(conversation_id) is not None for conversation_id in "abc"]
+
+    assert asyncio.run(run()) == [False, True, True]
+    assert len(conversations) == 2
+    assert conversations.size == 3 * message_size
+
+
+def test_stores_sharing_a_file_see_each_others_writes(db_path):
+    first = store(db_path)
+    second = store(db_path)
+
+    async def run():
+        await first.append("a", *turn("one"))
+        from_second = await second.messages("a")
+        await second.append("a", *turn("two"))
+        await second.compact("a", 2, "User: one", 3)
+        return from_second, await first.get("a")
+
+    from_second, conversation = asyncio.run(run())
+
+    assert from_second == list(turn("one"))
+    assert [msg.to_dict() for msg in conversation.messages] == list(turn("two"))
+    assert conversation.summary == "User: one"
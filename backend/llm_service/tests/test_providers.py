@@ -0,0 +1,178 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import app.providers
+from app.clients import ProviderClients
+from app.providers import EPHEMERAL, AnthropicProvider, Completion, Provider, ProviderRegistry
+from app.streaming import StreamModel
+
+
+class FakeProvider(Provider):
+    """Answers after `delay` seconds, and notes whether it was cancelled first."""
+
+    def __init__(self, name: str, model: str, delay: float = 0.0):
+        self.name = name
+        super().__init__(None, model)
+        self.delay = delay
+        self.calls = 0
+        self.cancelled = False
+
+    async def _complete(self, messages, temperature, system) -> Completion:
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return Completion(f"from {self.name}", self.model)
+
+    async def _stream(self, messages, temperature, system):
+        completion = await self._complete(messages, temperature, system)
+        yield completion.text
+
+
+def registry(*providers: FakeProvider) -> ProviderRegistry:
+    providers_by_name = ProviderRegistry(ProviderClients())
+    providers_by_name.providers = {provider.name: provider for provider in providers}
+    return providers_by_name
+
+
+@pytest.fixture(autouse=True)
+def short_hedge_delay(monkeypatch):
+    monkeypatch.setattr(app.providers, "HEDGE_DELAY_MS", "20")
+
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+@pytest.mark.parametrize("primary_delay, backup_delay, winner", [
+    (5.0, 0.05, "llama"),
+    (0.1, 5.0, "claude"),
+])
+def test_hedge_loser_is_cancelled(primary_delay, backup_delay, winner):
+    primary = FakeProvider("claude", "claude-sonnet-4-20250514", primary_delay)
+    backup = FakeProvider("llama", "llama-3.3-70b-versatile", backup_delay)
+    providers = registry(primary, backup)
+
+    async def run():
+        completion = await providers.complete("claude", MESSAGES, 0.7, routing="fast")
+        # Give the cancelled call a turn to unwind
+        await asyncio.sleep(0.05)
+        return completion
+
+    completion = asyncio.run(run())
+
+    loser = backup if winner == "claude" else primary
+    assert completion.text == f"from {winner}"
+    assert primary.calls == backup.calls == 1
+    assert loser.cancelled
+    assert primary.scheduler.stats()["in_flight"] == backup.scheduler.stats()["in_flight"] == 0
+
+
+def test_alternates_skip_models_too_small_for_the_prompt():
+    claude = FakeProvider("claude", "claude-sonnet-4-20250514")
+    gpt = FakeProvider("gpt", "gpt-4")
+    llama = FakeProvider("llama", "llama-3.3-70b-versatile")
+    providers = registry(claude, gpt, llama)
+
+    assert set(providers.alternates(claude, prompt_tokens=1000)) == {gpt, llama}
+    # gpt-4's 8k window is too small for a prompt budgeted for Claude
+    assert providers.alternates(claude, prompt_tokens=10000) == [llama]
+
+
+def test_long_prompt_is_not_hedged_to_a_smaller_model():
+    claude = FakeProvider("claude", "claude-sonnet-4-20250514", delay=0.1)
+    gpt = FakeProvider("gpt", "gpt-4")
+    providers = registry(claude, gpt)
+    long_messages = [{"role": "user", "content": "word " * 10000}]
+
+    completion = asyncio.run(providers.complete("claude", long_messages, 0.7, routing="fast"))
+
+    assert completion.text == "from claude"
+    assert gpt.calls == 0
+
+
+def test_hedged_request_counts_the_prompt_once(monkeypatch):
+    counted = []
+    monkeypatch.setattr(Provider, "count_prompt_tokens", lambda self, messages, system: counted.append(self.name) or 10)
+    primary = FakeProvider("claude", "claude-sonnet-4-20250514", delay=5.0)
+    backup = FakeProvider("llama", "llama-3.3-70b-versatile", delay=0.05)
+    providers = registry(primary, backup)
+
+    completion = asyncio.run(providers.complete("claude", MESSAGES, 0.7, routing="fast"))
+    assert completion.text == "from llama"
+    assert counted == ["claude"]
+
+    # A prompt the caller already counted is not counted again
+    asyncio.run(providers.complete("claude", MESSAGES, 0.7, routing="fast", prompt_tokens=10))
+    assert counted == ["claude"]
+
+
+def test_hedged_stream_names_the_winning_model():
+    primary = FakeProvider("claude", "claude-sonnet-4-20250514", delay=5.0)
+    backup = FakeProvider("llama", "llama-3.3-70b-versatile", delay=0.05)
+    providers = registry(primary, backup)
+
+    async def run():
+        return [item async for item in providers.stream("claude", MESSAGES, 0.7, routing="fast")]
+
+    assert asyncio.run(run()) == [StreamModel("llama-3.3-70b-versatile"), "from llama"]
+
+
+class FakeMessages:
+    """Records `messages.create` calls, like an Anthropic client."""
+
+    def __init__(self):
+        self.params = None
+
+    async def create(self, **params):
+        self.params = params
+        usage = SimpleNamespace(input_tokens=1, output_tokens=1)
+        return SimpleNamespace(content=[SimpleNamespace(text="ok")], usage=usage)
+
+
+def sent_to_claude(messages, system):
+    create = FakeMessages()
+    provider = AnthropicProvider(SimpleNamespace(messages=create), "claude-sonnet-4-20250514")
+    asyncio.run(provider.complete(messages, 0.7, system))
+    return create.params
+
+
+@pytest.fixture
+def prompt_caching(monkeypatch):
+    monkeypatch.setattr(app.providers, "CLAUDE_PROMPT_CACHING", True)
+
+
+def breakpoints(blocks):
+    return [block.get("cache_control") for block in blocks]
+
+
+def test_claude_breakpoints_on_last_system_sections_and_end_of_history(prompt_caching):
+    history = [
+        {"role": "user", "content": "first"},
+        {"role": "assistant", "content": "reply"},
+        {"role": "user", "content": "second"},
+    ]
+
+    params = sent_to_claude(history, ["instructions", "documents", "summary"])
+
+    assert breakpoints(params["system"]) == [None, EPHEMERAL, EPHEMERAL]
+    assert params["messages"][0] == history[0]
+    assert params["messages"][1] == {
+        "role": "assistant",
+        "content": [{"type": "text", "text": "reply", "cache_control": EPHEMERAL}],
+    }
+    assert params["messages"][2] == history[2]
+
+
+def test_claude_single_message_and_empty_system_have_no_breakpoints(prompt_caching):
+    params = sent_to_claude(MESSAGES, ["", ""])
+
+    assert params["messages"] == MESSAGES
+    assert "system" not in params
+
+    params = sent_to_claude(MESSAGES, "instructions")
+
+    assert breakpoints(params["system"]) == [EPHEMERAL]
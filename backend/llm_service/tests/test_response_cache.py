@@ -0,0 +1,53 @@
+import uuid
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.clients import ProviderClients
+from app.coalesce import Coalescer
+from app.providers import ProviderRegistry
+from app.response_cache import CACHE_HEADER, ResponseCache
+from app.routes.Llama import llamaRouter
+
+
+@pytest.fixture
+def llama_app(tmp_path, fake_chat_client):
+    # Created on the app's event loop, like the real lifespan does
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        app.state.providers = ProviderRegistry(ProviderClients(groq=fake_chat_client))
+        app.state.response_cache = ResponseCache(directory=str(tmp_path), max_temperature=0)
+        app.state.coalescer = Coalescer()
+        yield
+
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(llamaRouter)
+    return app
+
+
+def test_repeated_stateless_llama_prompt_is_a_hit(llama_app, fake_chat_client):
+    request = {"prompt": "What is the capital of France?", "temperature": 0}
+
+    with TestClient(llama_app) as client:
+        first = client.post("/llama/generate", json=request)
+        second = client.post("/llama/generate", json=request)
+
+    assert first.status_code == second.status_code == 200
+    assert first.headers[CACHE_HEADER] == "MISS"
+    assert second.headers[CACHE_HEADER] == "HIT"
+    assert second.json()["text"] == first.json()["text"]
+    assert len(fake_chat_client.chat.completions.calls) == 1
+
+
+def test_llama_conversation_turns_are_not_served_from_cache(llama_app, fake_chat_client):
+    request = {"prompt": "And then?", "temperature": 0, "conversation_id": uuid.uuid4().hex}
+
+    with TestClient(llama_app) as client:
+        first = client.post("/llama/generate", json=request)
+        second = client.post("/llama/generate", json=request)
+
+    # The second turn carries the first one as history, so it is a different prompt
+    assert first.headers[CACHE_HEADER] == second.headers[CACHE_HEADER] == "MISS"
+    assert len(fake_chat_client.chat.completions.calls) == 2
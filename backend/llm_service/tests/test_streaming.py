@@ -0,0 +1,72 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from app.streaming import StreamModel, anthropic_token_stream, sse_response
+
+
+class FakeMessageStream:
+    """Async context manager yielding raw events, like `client.messages.stream()`."""
+
+    def __init__(self, events):
+        self.events = events
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        for event in self.events:
+            yield event
+
+
+def anthropic_client(events):
+    return SimpleNamespace(messages=SimpleNamespace(stream=lambda **params: FakeMessageStream(events)))
+
+
+def collect(stream):
+    async def run():
+        return [item async for item in stream]
+    return asyncio.run(run())
+
+
+def test_anthropic_stream_usage_comes_from_message_start_and_delta():
+    usage = {"input_tokens": 12, "output_tokens": 1, "cache_read_input_tokens": 2000, "cache_creation_input_tokens": 30}
+    events = [
+        SimpleNamespace(type="message_start", message=SimpleNamespace(usage=usage)),
+        SimpleNamespace(type="content_block_start"),
+        SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="text_delta", text="Hello")),
+        SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="text_delta", text=" world")),
+        SimpleNamespace(type="content_block_stop"),
+        SimpleNamespace(type="message_delta", usage=SimpleNamespace(output_tokens=42)),
+        SimpleNamespace(type="message_stop"),
+    ]
+
+    items = collect(anthropic_token_stream(anthropic_client(events), model="claude", messages=[]))
+
+    assert items == ["Hello", " world", {
+        "prompt_tokens": 2042,
+        "completion_tokens": 42,
+        "total_tokens": 2084,
+        "cache_read_tokens": 2000,
+        "cache_write_tokens": 30,
+    }]
+
+
+def test_done_event_names_the_model_the_stream_reports():
+    async def tokens():
+        yield StreamModel("llama-3.3-70b-versatile")
+        yield "Hi"
+        yield {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4}
+
+    async def run():
+        response = sse_response(tokens(), "claude-sonnet-4-20250514")
+        return "".join([chunk async for chunk in response.body_iterator])
+
+    body = asyncio.run(run())
+
+    assert 'event: token\ndata: {"text": "Hi"}' in body
+    done = json.loads(body.split("event: done\ndata: ")[1])
+    assert done["model"] == "llama-3.3-70b-versatile"
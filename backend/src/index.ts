@@ -69,6 +69,14 @@ interface AIResponse {
 // Replace all instances of 'http://localhost:8000' with the production LLM service URL
 const LLM_SERVICE_URL = "https://llmservice-production-7cd2.up.railway.app";
 
+// How long we wait on the LLM service. It is told the same budget so it can
+// stop paying for a reply we have already given up on.
+const LLM_TIMEOUT_MS = 120_000;
+const llmDeadline = () => ({
+  headers: { "X-Request-Timeout": String(LLM_TIMEOUT_MS / 1000) },
+  signal: AbortSignal.timeout(LLM_TIMEOUT_MS),
+});
+
 const server = Bun.serve({
   port: 3000,
   async fetch(req) {
@@ -282,9 +290,10 @@ const server = Bun.serve({
           prompt: string;
           model: "gpt" | "claude" | "llama";
           temperature?: number;
+          conversationId?: string;
         };
 
-        const { prompt, model, temperature = 0.7 } = body;
+        const { prompt, model, temperature = 0.7, conversationId } = body;
 
         if (!prompt || !model) {
           return new Response(
@@ -293,16 +302,35 @@ const server = Bun.serve({
           );
         }
 
+        // History is kept per conversation by the LLM service; without an id
+        // the request is answered on its own
+        if (conversationId) {
+          const conversation = await prisma.conversation.findFirst({
+            where: {
+              id: conversationId,
+              userId: user.id,
+            },
+          });
+
+          if (!conversation) {
+            return new Response(JSON.stringify({ error: "Conversation not found" }), { status: 404, headers });
+          }
+        }
+
         try {
           // Call the FastAPI LLM service
+          const deadline = llmDeadline();
           const llmResponse = await fetch(`${LLM_SERVICE_URL}/${model}/generate`, {
             method: "POST",
             headers: {
               "Content-Type": "application/json",
+              ...deadline.headers,
             },
+            signal: deadline.signal,
             body: JSON.stringify({
               prompt,
               temperature,
+              conversation_id: conversationId,
             }),
           });
 
@@ -481,15 +509,18 @@ const server = Bun.serve({
           const formData = new FormData();
           formData.append('prompt', content);
           formData.append('temperature', '0.7');
+          formData.append('conversation_id', conversationId);
           aiResponse = await fetch(`${LLM_SERVICE_URL}/gpt/generate-form`, {
             method: 'POST',
             body: formData,
+            ...llmDeadline(),
           }).then(res => res.json());
         } else if (model === 'claude') {
           // For Claude, always use FormData (supports file or just prompt)
           const formData = new FormData();
           formData.append('prompt', content);
           formData.append('temperature', '0.7');
+          formData.append('conversation_id', conversationId);
           if (attachments && Array.isArray(attachments) && attachments.length > 0) {
             const fileAtt = attachments[0];
             if (fileAtt && fileAtt.url && typeof fileAtt.url === 'string' && !fileAtt.url.startsWith('blob:')) {
@@ -503,16 +534,21 @@ const server = Bun.serve({
           aiResponse = await fetch(`${LLM_SERVICE_URL}/claude/generate`, {
             method: 'POST',
             body: formData,
+            ...llmDeadline(),
           }).then(res => res.json());
         } else {
+          const deadline = llmDeadline();
           aiResponse = await fetch(`${LLM_SERVICE_URL}/${model}/generate`, {
             method: 'POST',
             headers: {
               'Content-Type': 'application/json',
+              ...deadline.headers,
             },
+            signal: deadline.signal,
             body: JSON.stringify({
               prompt: content,
               temperature: 0.7,
+              conversation_id: conversationId,
             }),
           }).then(res => res.json());
         }
@@ -175,6 +175,8 @@ export const useChatStore = create<ChatStore>()(
               formData.append('prompt', message.content);
               formData.append('temperature', '0.7');
               formData.append('file', file);
+              // The LLM service keeps history per conversation; without an id each request stands alone
+              formData.append('conversation_id', chatId);
               // Choose endpoint based on model
               let endpoint = '';
               if (message.model === 'claude') {
@@ -234,7 +236,8 @@ export const useChatStore = create<ChatStore>()(
               },
               body: JSON.stringify({
                 prompt: message.content,
-                temperature: 0.7
+                temperature: 0.7,
+                conversation_id: chatId,
               }),
             });
 